@@ -0,0 +1,39 @@
+import logging
+
+
+class Availability(object):
+    """Owns the retained availability (LWT) topic.
+
+    The broker publishes ``offline`` through the will when the connection
+    drops. ``online`` is published once per connection (birth), again when
+    Home Assistant announces it restarted on ``<discovery base>/status``,
+    and, if enabled, by a low-rate heartbeat that runs on its own timer.
+    Data publishes never touch the topic.
+    """
+
+    def __init__(self, myqtt, topic, online="online", offline="offline", retain=True):
+        self.myqtt = myqtt
+        self.topic = topic
+        self.online = online
+        self.offline = offline
+        self.retain = retain
+
+    def set_will(self, client):
+        client.will_set(topic=self.topic, payload=self.offline, retain=self.retain)
+
+    def birth(self):
+        logging.debug("Publishing '{}' to '{}'".format(self.online, self.topic))
+        self.myqtt.publish(self.topic, self.online, retain=self.retain)
+
+    def heartbeat(self):
+        self.birth()
+
+    def goodbye(self):
+        logging.debug("Publishing '{}' to '{}'".format(self.offline, self.topic))
+        self.myqtt.publish(self.topic, self.offline, retain=self.retain)
+
+    def on_ha_status(self, client, userdata, message):
+        status = message.payload.decode("utf-8")
+        logging.info("Home Assistant is {}".format(status))
+        if status == "online":
+            self.birth()
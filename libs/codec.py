@@ -0,0 +1,70 @@
+import json, zlib, logging
+from decimal import Decimal
+
+from libs.collectors import load_backend
+
+
+def _plain(value):
+    # cbor/msgpack/json cannot all serialise Decimal (or anything exotic)
+    if isinstance(value, Decimal):
+        return float(value)
+    return str(value)
+
+
+class Codec(object):
+    """Encodes telemetry payloads.
+
+    ``text`` keeps the historical format: scalars are published as they
+    are and documents as compact JSON. ``json`` encodes every payload as
+    compact JSON, ``cbor`` and ``msgpack`` as binary (they need the cbor2 or
+    msgpack package). With ``compress_min`` set, encoded payloads of at
+    least that many bytes are zlib-compressed, which pays off for the state
+    document and backlog, not for single values.
+
+    ``encode`` returns ``(payload, content_type)``; the content type gets a
+    ``+zlib`` suffix when the payload was compressed. ``text`` payloads go
+    out without a content type unless they were compressed. Compressed
+    payloads can only be told apart by their MQTT v5 content type, so the
+    configuration requires MQTT_V5 for ``compress_min``.
+    """
+
+    CONTENT_TYPES = {"text": "text/plain",
+                     "json": "application/json",
+                     "cbor": "application/cbor",
+                     "msgpack": "application/msgpack"}
+    BACKENDS = {"cbor": "cbor2", "msgpack": "msgpack"}
+
+    def __init__(self, name="text", compress_min=0):
+        if name not in self.CONTENT_TYPES:
+            raise ValueError("Unknown payload codec '{}', expected one of {}".format(name, sorted(self.CONTENT_TYPES)))
+        self.name = name
+        self.content_type = self.CONTENT_TYPES[name]
+        self.compress_min = compress_min
+        self.backend = load_backend(self.BACKENDS[name]) if name in self.BACKENDS else None
+
+    def __dump(self, value):
+        if self.name == "cbor":
+            return self.backend.dumps(value, default=lambda encoder, v: encoder.encode(_plain(v)))
+        if self.name == "msgpack":
+            return self.backend.packb(value, default=_plain)
+        if self.name == "json" or isinstance(value, (dict, list, tuple)):
+            return json.dumps(value, default=_plain, separators=(",", ":"))
+        if isinstance(value, bool):
+            return "true" if value else "false"
+        return value
+
+    def encode(self, value):
+        payload = self.__dump(value)
+        content_type = self.content_type
+        if self.name == "text" and isinstance(value, (dict, list, tuple)):
+            content_type = self.CONTENT_TYPES["json"]
+        if self.compress_min:
+            data = payload.encode("utf-8") if isinstance(payload, str) else payload
+            if isinstance(data, bytes) and len(data) >= self.compress_min:
+                compressed = zlib.compress(data)
+                logging.debug("Compressed payload {} -> {} bytes".format(len(data), len(compressed)))
+                return compressed, content_type + "+zlib"
+        if self.name == "text":
+            # the historical format, which consumers read without a content type
+            return payload, None
+        return payload, content_type
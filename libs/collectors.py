@@ -0,0 +1,56 @@
+import importlib, logging, sys
+
+
+class Collector(object):
+    """Describes one collector: the method that publishes it, the config key
+    holding its period, when it is enabled and which optional backend
+    modules it needs. Backends are only imported for enabled collectors.
+    ``per_node`` collectors read Proxmox node data and run once for every
+    node listed in PVE_NODES.
+    """
+
+    def __init__(self, name, method, period_key=None, enabled=None, backends=(), per_node=False):
+        self.name = name
+        self.method = method
+        self.period_key = period_key
+        self.enabled = enabled
+        self.backends = backends
+        self.per_node = per_node
+
+    def is_enabled(self, config):
+        if self.enabled is None:
+            return True
+        return bool(self.enabled(config))
+
+
+REGISTRY = []
+
+
+def collector(name, period_key=None, enabled=None, backends=(), per_node=False):
+    """Register the decorated Publisher (or System2Mqtt) method as a collector."""
+    def decorator(func):
+        REGISTRY.append(Collector(name, func.__name__, period_key, enabled, backends, per_node))
+        return func
+    return decorator
+
+
+def load_backend(module_name):
+    """Import an optional backend module the first time it is needed."""
+    module = sys.modules.get(module_name)
+    if module is None:
+        logging.debug("Loading backend '{}'".format(module_name))
+        module = importlib.import_module(module_name)
+    return module
+
+
+def enabled_collectors(config):
+    """Return the enabled collectors, importing the backends they need."""
+    enabled = []
+    for spec in REGISTRY:
+        if not spec.is_enabled(config):
+            logging.debug("Collector '{}' is disabled".format(spec.name))
+            continue
+        for module_name in spec.backends:
+            load_backend(module_name)
+        enabled.append(spec)
+    return enabled
@@ -0,0 +1,249 @@
+import hashlib, threading, time, logging
+
+from libs.homeassistant import ha_config, ha_entity, ha_device_config
+
+
+class RateLimiter(object):
+    """Spaces out calls to ``wait`` to at most ``rate`` per second, across threads."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_slot = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class DiscoveryRegistry(object):
+    """Home Assistant discovery configs, sent only when needed.
+
+    Collectors register their entities with ``add`` on every run. An
+    entity's config is only rebuilt when its arguments change, and only
+    sent when its content hash differs from the one sent before (e.g. a
+    new ``off_delay`` after the publish period changed). ``republish``
+    queues every config again, for when Home Assistant announces that it
+    (re)started and after reconnecting to the broker.
+
+    Changes are queued and go out on ``flush``, on a background thread, at
+    most ``rate`` per second. Registries publishing over the same
+    connection can share one ``limiter`` instead, so the rate holds for all
+    of them together. Changes stay queued while the broker is unreachable.
+
+    With ``compact`` set, configs use abbreviated keys, topics below
+    ``base_topic`` are written relative to ``~``, and only the first entity
+    registered for a device carries the full device block; the others
+    refer to it by its identifiers. When that entity is removed, the next
+    one of the device is sent again with the block.
+
+    With ``device_topic`` set (a template taking the device identifier),
+    all entities of a device are announced in one device discovery message
+    with a component per entity, which is sent again when an entity is
+    added, changed or removed. A removed entity stays in it as a bare
+    component until that message has been sent once.
+
+    Collectors wrapped with ``track`` own the entities they register. An
+    entity its collector has not registered for ``remove_after`` runs is
+    removed from Home Assistant. Runs that register nothing at all are
+    taken for failed reads and do not count.
+    """
+
+    def __init__(self, myqtt, rate=20, base_topic=None, compact=False, device_topic=None, remove_after=3,
+                 limiter=None):
+        self.myqtt = myqtt
+        self.limiter = limiter or RateLimiter(rate)
+        self.base_topic = base_topic
+        self.compact = compact
+        self.device_topic = device_topic
+        self.remove_after = remove_after
+        self.device_owners = {}
+        self.fields = {}
+        self.configs = {}
+        self.hashes = {}
+        self.pending = {}
+        self.components = {}
+        self.devices = {}
+        self.owners = {}
+        self.missed = {}
+        self.local = threading.local()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def track(self, owner, func):
+        """Wrap a collector so the entities it stops registering get removed."""
+        def run(*args):
+            self.local.seen = set()
+            try:
+                return func(*args)
+            finally:
+                seen, self.local.seen = self.local.seen, None
+                self.__expire(owner, seen)
+        return run
+
+    def add(self, discovery_topic, **fields):
+        seen = getattr(self.local, "seen", None)
+        if seen is not None:
+            seen.add(discovery_topic)
+        with self.lock:
+            if self.fields.get(discovery_topic) == fields:
+                return
+            self.fields[discovery_topic] = fields
+            owner = self.device_owners.setdefault(fields.get("device"), discovery_topic)
+        if self.device_topic:
+            component = ha_entity(base_topic=self.base_topic, abbreviated=self.compact, **fields)
+            for key in ("~", "device", "dev"):
+                component.pop(key, None)
+            component["p" if self.compact else "platform"] = fields["entity_type"]
+            with self.lock:
+                self.components.setdefault(fields["device"], {})[fields["object_id"]] = component
+                self.__update_device(fields["device"])
+            return
+        if self.compact:
+            payload = ha_config(discovery_topic, base_topic=self.base_topic, abbreviated=True,
+                                device_info=owner == discovery_topic, **fields)[1]
+        else:
+            payload = ha_config(discovery_topic, **fields)[1]
+        with self.lock:
+            self.__queue(discovery_topic, payload)
+
+    def remove(self, discovery_topic):
+        """Remove an entity from Home Assistant."""
+        with self.lock:
+            fields = self.fields.pop(discovery_topic, None)
+            self.owners.pop(discovery_topic, None)
+            self.missed.pop(discovery_topic, None)
+            if fields is None:
+                return
+            logging.info("Removing discovery for '{}'".format(discovery_topic))
+            if self.device_topic:
+                # a component reduced to its platform tells Home Assistant to drop the entity
+                components = self.components[fields["device"]]
+                components[fields["object_id"]] = {"p" if self.compact else "platform": fields["entity_type"]}
+                self.__update_device(fields["device"])
+                return
+            self.configs.pop(discovery_topic, None)
+            self.hashes.pop(discovery_topic, None)
+            self.pending[discovery_topic] = ""
+            device = fields.get("device")
+            if self.device_owners.get(device) == discovery_topic:
+                del self.device_owners[device]
+                if self.compact:
+                    self.__hand_over(device)
+
+    def __hand_over(self, device):
+        # called with the lock held: the next entity of the device carries its full block
+        for topic, fields in self.fields.items():
+            if fields.get("device") == device:
+                self.device_owners[device] = topic
+                payload = ha_config(topic, base_topic=self.base_topic, abbreviated=True, **fields)[1]
+                self.__queue(topic, payload)
+                return
+
+    def __expire(self, owner, seen):
+        if not seen:
+            return
+        gone = []
+        with self.lock:
+            for topic in seen:
+                self.owners[topic] = owner
+                self.missed.pop(topic, None)
+            for topic, topic_owner in self.owners.items():
+                if topic_owner != owner or topic in seen:
+                    continue
+                self.missed[topic] = self.missed.get(topic, 0) + 1
+                if self.missed[topic] >= self.remove_after:
+                    gone.append(topic)
+        for topic in gone:
+            self.remove(topic)
+
+    def __update_device(self, device):
+        # called with the lock held
+        topic, payload = ha_device_config(self.device_topic.format(device), device, self.components[device],
+                                          base_topic=self.base_topic, abbreviated=self.compact)
+        self.devices[topic] = device
+        self.__queue(topic, payload)
+
+    def __removed_components(self, topic):
+        # called with the lock held: object ids of the removed entities in the device's current config
+        device = self.devices.get(topic)
+        if device is None:
+            return ()
+        platform = "p" if self.compact else "platform"
+        return [object_id for object_id, component in self.components[device].items()
+                if list(component) == [platform]]
+
+    def __drop_removed(self, topic, removed):
+        """Forget removed entities once the device config announcing their removal was sent."""
+        with self.lock:
+            device = self.devices[topic]
+            components = self.components[device]
+            platform = "p" if self.compact else "platform"
+            for object_id in removed:
+                if list(components.get(object_id, ())) == [platform]:
+                    del components[object_id]
+            if components:
+                # the config sent next time, without them; the retained one is fine until then
+                payload = ha_device_config(topic, device, components,
+                                           base_topic=self.base_topic, abbreviated=self.compact)[1]
+                self.configs[topic] = payload
+                self.hashes[topic] = hashlib.sha1(payload.encode("utf-8")).hexdigest()
+                return
+            # no entity left: remove the device
+            del self.components[device]
+            del self.devices[topic]
+            self.configs.pop(topic, None)
+            self.hashes.pop(topic, None)
+            self.pending[topic] = ""
+
+    def __queue(self, topic, payload):
+        # called with the lock held
+        digest = hashlib.sha1(payload.encode("utf-8")).hexdigest()
+        if self.hashes.get(topic) == digest:
+            return
+        logging.debug("Discovery config for '{}' changed".format(topic))
+        self.hashes[topic] = digest
+        self.configs[topic] = payload
+        self.pending[topic] = payload
+
+    def flush(self):
+        """Start sending the queued configs."""
+        with self.lock:
+            self.__start()
+
+    def republish(self):
+        """Queue every known config again and send them."""
+        with self.lock:
+            logging.info("Republishing {} discovery config(s)".format(len(self.configs)))
+            self.pending = dict(self.configs)
+            self.__start()
+
+    def __start(self):
+        # called with the lock held
+        if self.thread is not None or not self.pending:
+            return
+        self.thread = threading.Thread(target=self.__send_pending, name="s2m-discovery", daemon=True)
+        self.thread.start()
+
+    def __send_pending(self):
+        while True:
+            with self.lock:
+                if not self.pending or not self.myqtt.client.is_connected():
+                    self.thread = None
+                    return
+                topic = next(iter(self.pending))
+                payload = self.pending.pop(topic)
+                removed = self.__removed_components(topic) if payload else ()
+            self.limiter.wait()
+            try:
+                self.myqtt.publish(topic, payload, retain=True)
+                if removed:
+                    self.__drop_removed(topic, removed)
+            except Exception as e:
+                logging.error(e, exc_info=True)
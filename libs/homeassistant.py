@@ -1,15 +1,60 @@
 import logging
 import json
 
-def ha_config(discovery_topic, name, object_id, state_topic, device, entity_type,
+# https://www.home-assistant.io/integrations/mqtt/#supported-abbreviations-in-mqtt-discovery-messages
+ABBREVIATIONS = {
+    "availability": "avty",
+    "components": "cmps",
+    "device": "dev",
+    "device_class": "dev_cla",
+    "icon": "ic",
+    "identifiers": "ids",
+    "manufacturer": "mf",
+    "model": "mdl",
+    "object_id": "obj_id",
+    "off_delay": "off_dly",
+    "origin": "o",
+    "payload_available": "pl_avail",
+    "payload_not_available": "pl_not_avail",
+    "payload_off": "pl_off",
+    "payload_on": "pl_on",
+    "platform": "p",
+    "state_topic": "stat_t",
+    "topic": "t",
+    "unique_id": "uniq_id",
+    "unit_of_measurement": "unit_of_meas",
+    "value_template": "val_tpl",
+}
+
+
+def abbreviate(payload):
+    """Replace discovery keys with their abbreviations, including in nested blocks."""
+    if isinstance(payload, dict):
+        return {ABBREVIATIONS.get(k, k): abbreviate(v) for k, v in payload.items()}
+    if isinstance(payload, list):
+        return [abbreviate(v) for v in payload]
+    return payload
+
+
+def ha_device(device):
+    """The device block shared by all entities of a monitored system."""
+    return {
+        "identifiers": [device],  # Should be a list
+        "name": f"S2M {device.title()}",
+        "manufacturer": "TeamGREEN Tech",
+        "model": "System2Mqtt"
+    }
+
+
+def ha_entity(name, object_id, state_topic, device, entity_type,
               icon=None, device_class=None, unit=None, availability_topic=None,
               payload_available="online", payload_not_available="offline",
-              payload_on=None, payload_off=None, off_delay=None):
+              payload_on=None, payload_off=None, off_delay=None, value_template=None,
+              base_topic=None, abbreviated=False, device_info=True):
     """
-    Generate Home Assistant MQTT discovery configuration.
+    Build the Home Assistant MQTT discovery configuration of one entity.
     
     Args:
-        discovery_topic: MQTT topic for discovery
         name: Entity display name
         object_id: Unique object identifier
         state_topic: Topic where entity state is published
@@ -24,9 +69,14 @@ def ha_config(discovery_topic, name, object_id, state_topic, device, entity_type
         payload_on: Payload for "on" state (for binary sensors/switches)
         payload_off: Payload for "off" state (for binary sensors/switches)
         off_delay: Delay before switching to off state
+        value_template: Template extracting the value from a JSON state_topic (optional)
+        base_topic: Topics below it are written as "~/..." with "~" set to it (optional)
+        abbreviated: Use Home Assistant's abbreviated keys (default: False)
+        device_info: Include the full device block; with False only its identifiers are
+            sent, for entities of a device another config already describes (default: True)
     
     Returns:
-        tuple: (discovery_topic, config_payload_json)
+        dict: the configuration payload
     """
     logging.debug(f"Creating HA config for entity_type: {entity_type}")
     
@@ -35,13 +85,10 @@ def ha_config(discovery_topic, name, object_id, state_topic, device, entity_type
         "unique_id": object_id,
         "object_id": object_id,
         "state_topic": state_topic,
-        "device": {
-            "identifiers": [device],  # Should be a list
-            "name": f"S2M {device.title()}",
-            "manufacturer": "TeamGREEN Tech",
-            "model": "System2Mqtt"
-        }
+        "device": ha_device(device)
     }
+    if not device_info:
+        payload["device"] = {"identifiers": [device]}
     
     # Add availability configuration if topic is provided
     if availability_topic:
@@ -58,6 +105,8 @@ def ha_config(discovery_topic, name, object_id, state_topic, device, entity_type
         payload["payload_off"] = payload_off
     if off_delay:
         payload["off_delay"] = off_delay
+    if value_template:
+        payload["value_template"] = value_template
     if unit:
         payload["unit_of_measurement"] = unit
     if icon:
@@ -65,13 +114,75 @@ def ha_config(discovery_topic, name, object_id, state_topic, device, entity_type
     if device_class:
         payload["device_class"] = device_class
 
-    config_payload = json.dumps(payload, indent=2)
+    if base_topic:
+        prefix = base_topic + "/"
+        shortened = False
+        for block, key in ((payload, "state_topic"), (payload.get("availability", {}), "topic")):
+            if block.get(key, "").startswith(prefix):
+                block[key] = "~/" + block[key][len(prefix):]
+                shortened = True
+        if shortened:
+            payload["~"] = base_topic
+    if abbreviated:
+        # leave out what Home Assistant assumes anyway
+        availability = payload.get("availability", {})
+        if availability.get("payload_available") == "online":
+            del availability["payload_available"]
+        if availability.get("payload_not_available") == "offline":
+            del availability["payload_not_available"]
+        payload = abbreviate(payload)
+    return payload
+
+
+def ha_config(discovery_topic, *args, **kwargs):
+    """
+    Generate Home Assistant MQTT discovery configuration.
+
+    Takes the discovery topic followed by the arguments of ha_entity().
+
+    Returns:
+        tuple: (discovery_topic, config_payload_json)
+    """
+    config_payload = json.dumps(ha_entity(*args, **kwargs), separators=(",", ":"))
     logging.debug(f"Discovery Topic: {discovery_topic}")
     logging.debug(f"Discovery Payload:\n{config_payload}")
     
     return (discovery_topic, config_payload)
 
 
+def ha_device_config(discovery_topic, device, components, base_topic=None, abbreviated=False):
+    """
+    Generate a device based discovery configuration, announcing all entities of
+    ``device`` in one message.
+
+    Args:
+        discovery_topic: MQTT topic for discovery (<prefix>/device/<device>/config)
+        device: Device identifier
+        components: Entity configurations by object id, each with a "platform" key
+            and without a device block. A component with only its platform removes
+            that entity.
+        base_topic: Value of "~" for topics written relative to it (optional)
+        abbreviated: Use Home Assistant's abbreviated keys (default: False)
+
+    Returns:
+        tuple: (discovery_topic, config_payload_json)
+    """
+    payload = {
+        "device": ha_device(device),
+        "origin": {"name": "system2mqtt"},
+        "components": components
+    }
+    if base_topic:
+        payload["~"] = base_topic
+    if abbreviated:
+        payload = abbreviate(payload)
+    config_payload = json.dumps(payload, separators=(",", ":"))
+    logging.debug(f"Discovery Topic: {discovery_topic}")
+    logging.debug(f"Discovery Payload:\n{config_payload}")
+
+    return (discovery_topic, config_payload)
+
+
 # Example usage:
 def create_sensor_with_availability():
     """Example of creating a sensor with availability tracking"""
@@ -0,0 +1,95 @@
+import os, re, select, threading, logging
+
+from libs.procfs import PinnedFile
+
+
+def mountinfo_available(procpath=None):
+    return hasattr(select, "poll") and os.path.exists(os.path.join(procpath or "/proc", "self", "mountinfo"))
+
+
+class MountWatcher(object):
+    """Publishes mount and unmount events as they happen.
+
+    The kernel flags /proc/self/mountinfo with POLLPRI whenever the mount
+    table changes, so the watcher thread sleeps in poll() and only rereads
+    the table when something was mounted or unmounted. Only mounts backed
+    by a real block device filesystem (plus zfs) are reported, the same
+    set psutil.disk_partitions(all=False) returns.
+
+    ``callback(mounted, unmounted)`` receives two sets of mountpoints.
+    The mounts reported as mounted are remembered, so ``refresh`` can also
+    report the ones that went away while the reports were not delivered.
+    """
+
+    OCTAL_ESCAPE = re.compile(r"\\([0-7]{3})")
+
+    def __init__(self, callback, procpath=None):
+        self.procpath = procpath or "/proc"
+        self.callback = callback
+        self.mountinfo = PinnedFile(os.path.join(self.procpath, "self", "mountinfo"), size=16384)
+        self.fstypes = self.__physical_fstypes()
+        self.mounts = self.read_mounts()
+        self.reported = set()
+        self.thread = None
+        self.stop_r, self.stop_w = os.pipe()
+
+    def __physical_fstypes(self):
+        fstypes = {"zfs"}
+        with open(os.path.join(self.procpath, "filesystems"), "r") as f:
+            for line in f:
+                if not line.startswith("nodev"):
+                    fstypes.add(line.strip())
+        return fstypes
+
+    def __unescape(self, path):
+        return self.OCTAL_ESCAPE.sub(lambda m: chr(int(m.group(1), 8)), path)
+
+    def read_mounts(self):
+        mounts = set()
+        for line in self.mountinfo.read().decode("utf-8", "replace").splitlines():
+            pre, _, post = line.partition(" - ")
+            fields = pre.split()
+            post = post.split()
+            if len(fields) < 5 or len(post) < 2:
+                continue
+            fstype, device = post[0], post[1]
+            if device in ("", "none") or fstype not in self.fstypes:
+                continue
+            mounts.add(self.__unescape(fields[4]))
+        return mounts
+
+    def __report(self, mounted, unmounted):
+        self.callback(mounted, unmounted)
+        self.reported = (self.reported | mounted) - unmounted
+
+    def refresh(self):
+        """Report every current mount again, and every reported one that is gone, e.g. after reconnecting."""
+        mounts = set(self.mounts)
+        self.__report(mounts, self.reported - mounts)
+
+    def __watch(self):
+        poller = select.poll()
+        poller.register(self.mountinfo.fd, select.POLLPRI | select.POLLERR)
+        poller.register(self.stop_r, select.POLLIN)
+        while True:
+            events = poller.poll()
+            if any(fd == self.stop_r for fd, _ in events):
+                break
+            current = self.read_mounts()
+            mounted = current - self.mounts
+            unmounted = self.mounts - current
+            self.mounts = current
+            if mounted or unmounted:
+                logging.info("Mount table changed: +{} -{}".format(sorted(mounted), sorted(unmounted)))
+                try:
+                    self.__report(mounted, unmounted)
+                except Exception as e:
+                    logging.error(e, exc_info=True)
+
+    def start(self):
+        logging.info("Watching {} for mount changes".format(self.mountinfo.path))
+        self.thread = threading.Thread(target=self.__watch, name="s2m-mountwatch", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        os.write(self.stop_w, b"x")
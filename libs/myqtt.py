@@ -1,10 +1,101 @@
 import paho.mqtt.client as mqtt
+from paho.mqtt.properties import Properties
+from paho.mqtt.packettypes import PacketTypes
 
-import logging, time
+import logging, time, asyncio, threading
+
+
+class AsyncioHelper(object):
+    """Drives a paho client's socket from an asyncio event loop instead of paho's loop thread.
+
+    Based on paho's loop_asyncio example. Publishing from collector threads
+    makes paho ask for write readiness from those threads too, so changes to
+    the loop's reader/writer set are handed to the loop thread when needed.
+    """
+
+    def __init__(self, loop, client):
+        self.loop = loop
+        self.client = client
+        self.misc = None
+        self.thread_id = threading.get_ident()
+        self.client.on_socket_open = self.on_socket_open
+        self.client.on_socket_close = self.on_socket_close
+        self.client.on_socket_register_write = self.on_socket_register_write
+        self.client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def __call(self, func, *args):
+        if threading.get_ident() == self.thread_id:
+            func(*args)
+        else:
+            self.loop.call_soon_threadsafe(func, *args)
+
+    def __open(self, sock):
+        self.loop.add_reader(sock, self.client.loop_read)
+        if self.misc is None or self.misc.done():
+            self.misc = self.loop.create_task(self.misc_loop())
+
+    def on_socket_open(self, client, userdata, sock):
+        logging.debug("Socket opened")
+        self.__call(self.__open, sock)
+
+    def on_socket_close(self, client, userdata, sock):
+        logging.debug("Socket closed")
+        self.__call(self.loop.remove_reader, sock)
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.__call(self.loop.add_writer, sock, self.client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.__call(self.loop.remove_writer, sock)
+
+    async def misc_loop(self):
+        # keepalive pings and QoS retries, paho expects this about once a second
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+
+class TopicAliases(object):
+    """Client side MQTT v5 topic aliases for one connection.
+
+    A topic gets an alias the second time it is published, so one-off
+    topics (discovery, commands) do not use up the broker's
+    TopicAliasMaximum. The first publish with an alias carries the full
+    topic to set the mapping up; later publishes send an empty topic.
+    """
+
+    def __init__(self):
+        self.maximum = 0
+        self.aliases = {}
+        self.seen = set()
+        self.lock = threading.Lock()
+
+    def reset(self, maximum):
+        """Start over for a new connection, aliases do not survive reconnects."""
+        with self.lock:
+            self.maximum = maximum
+            self.aliases = {}
+            self.seen = set()
+
+    def resolve(self, topic):
+        """Return (topic to send, alias or None). Call with ``lock`` held until the message is queued."""
+        alias = self.aliases.get(topic)
+        if alias is not None:
+            return "", alias
+        if len(self.aliases) >= self.maximum:
+            return topic, None
+        if topic not in self.seen:
+            if len(self.seen) > 4096:
+                self.seen.clear()
+            self.seen.add(topic)
+            return topic, None
+        alias = self.aliases[topic] = len(self.aliases) + 1
+        logging.debug("Topic alias {} -> {}".format(alias, topic))
+        return topic, alias
 
 
 class Myqtt(object):
-    def __init__(self, host, port=1883, username=None, password=None):
+    def __init__(self, host, port=1883, username=None, password=None, protocol_v5=False, client_id="",
+                 session_expiry=3600):
         logging.debug("")
 
         self.host = host
@@ -15,18 +106,44 @@ class Myqtt(object):
         self.connected_flag = False
         self.topic_callbacks = {}
         self.connected_callback = None
+        self.disconnected_callback = None
 
-        self.lwt_topic = None
-        self.lwt_offline_payload = "offline"
-        self.lwt_online_payload = "online"
-        self.lwt_retain = True
+        self.availability = None
+        self.policies = None
 
-        self.client = mqtt.Client()
+        self.v5 = protocol_v5
+        self.session_expiry = session_expiry
+        self.aliases = TopicAliases()
+        if self.v5:
+            self.client = mqtt.Client(client_id=client_id, protocol=mqtt.MQTTv5)
+        else:
+            self.client = mqtt.Client()
 
     def run(self):
+        self.__setup()
+        self.client.connect_async(self.host, self.port, **self.__connect_args())
+        self.client.loop_start()
+
+    def run_async(self, loop):
+        """Set the client up to be driven by an asyncio loop, call connect() to open the connection."""
+        self.__setup()
+        self.asyncio_helper = AsyncioHelper(loop, self.client)
+
+    def connect(self):
+        self.client.connect(self.host, self.port, **self.__connect_args())
+
+    def __connect_args(self):
+        if not self.v5:
+            return {}
+        # resume the broker side session (subscriptions, queued QoS 1/2) after a reconnect
+        properties = Properties(PacketTypes.CONNECT)
+        properties.SessionExpiryInterval = self.session_expiry
+        return {"clean_start": mqtt.MQTT_CLEAN_START_FIRST_ONLY, "properties": properties}
+
+    def __setup(self):
         logging.debug("{}, {}, {}, {}".format(self.host, self.port, self.username, "<redacted>"))
-        if self.lwt_topic:
-            self.client.will_set(topic=self.lwt_topic, payload=self.lwt_offline_payload, retain=self.lwt_retain)
+        if self.availability:
+            self.availability.set_will(self.client)
         if self.username and self.password:
             self.client.username_pw_set(self.username, self.password)
         self.client.reconnect_delay_set(min_delay=1, max_delay=120)
@@ -40,19 +157,56 @@ class Myqtt(object):
         logging.info("Attempting to connect to mqtt broker...")
         logging.info("Host: {}".format(self.host))
         logging.info("User: {}".format(self.username))
-        self.client.connect_async(self.host, self.port)
-        self.client.loop_start()
 
-    def publish(self, topic, payload, qos=0, retain=False):
+    def publish(self, topic, payload, qos=0, retain=False, expiry=None, content_type=None):
+        """Publish a message. ``expiry`` (seconds) and ``content_type`` are sent as MQTT v5 properties."""
         logging.debug("topic: {}\npayload: {}".format(topic, payload))
-        self.client.publish(topic, payload, qos, retain)
-        if self.lwt_topic:
-            self.client.publish(topic=self.lwt_topic, payload=self.lwt_online_payload, retain=self.lwt_retain)
+        if not self.policies:
+            self.__publish(topic, payload, qos, retain, expiry, content_type)
+            return
+        policy = self.policies.lookup(topic)
+        if policy.qos is not None:
+            qos = policy.qos
+        if policy.retain is not None:
+            retain = policy.retain
+        if policy.expiry is not None:
+            expiry = policy.expiry
+        if self.policies.admit(policy, qos, (topic, payload, qos, retain, expiry, content_type)):
+            self.__send(policy, topic, payload, qos, retain, expiry, content_type)
+
+    def __publish(self, topic, payload, qos, retain, expiry, content_type):
+        if not self.v5:
+            return self.client.publish(topic, payload, qos, retain)
+        properties = Properties(PacketTypes.PUBLISH)
+        if expiry:
+            properties.MessageExpiryInterval = int(expiry)
+        if content_type:
+            properties.ContentType = content_type
+        if qos:
+            # QoS 1/2 messages may be resent on a later connection, where the alias means nothing
+            return self.client.publish(topic, payload, qos, retain, properties)
+        with self.aliases.lock:
+            # the message that sets an alias up must be queued before the ones that use it
+            topic, alias = self.aliases.resolve(topic)
+            if alias is not None:
+                properties.TopicAlias = alias
+            return self.client.publish(topic, payload, qos, retain, properties)
+
+    def __send(self, policy, topic, payload, qos, retain, expiry, content_type):
+        info = self.__publish(topic, payload, qos, retain, expiry, content_type)
+        self.__send_queued(self.policies.sent(policy, qos, info.mid))
+
+    def __send_queued(self, messages):
+        for topic, payload, qos, retain, expiry, content_type in messages:
+            self.__send(self.policies.lookup(topic), topic, payload, qos, retain, expiry, content_type)
 
+    def __reason(self, rc):
+        # MQTT v5 passes ReasonCodes, 3.1.1 a plain int
+        return rc.getName() if hasattr(rc, "getName") else rc
 
     #### callbacks ####
 
-    def on_connect(self, client, userdata, flags, rc):
+    def on_connect(self, client, userdata, flags, rc, properties=None):
         logging.debug("")
         return_codes = {0: "Connection successful",
                         1: "Connection refused – incorrect protocol version",
@@ -61,22 +215,33 @@ class Myqtt(object):
                         4: "Connection refused – bad username or password",
                         5: "Connection refused – not authorised"}
         if rc==0:
-            logging.info("Connection Code: {}".format(return_codes[rc]))
+            logging.info("Connection Code: {}".format(return_codes[0]))
             self.connected_flag = True
+            if self.v5:
+                self.aliases.reset(getattr(properties, "TopicAliasMaximum", 0))
+                logging.info("MQTT v5 session present: {}, topic aliases: {}".format(
+                    flags.get("session present"), self.aliases.maximum))
+            if self.policies:
+                self.__send_queued(self.policies.reset())
             self.subscription_setup()
-            if self.lwt_topic:
-                self.publish(topic=self.lwt_topic, payload=self.lwt_online_payload, retain=self.lwt_retain)
+            if self.availability:
+                self.availability.birth()
             else:
                 logging.warning("no lwt topic set")
             if self.connected_callback:
                 logging.debug("Calling the 'connected_callback'")
                 self.connected_callback()
+        elif self.v5:
+            logging.error("Connection refused – {}".format(self.__reason(rc)))
         else:
             logging.error(return_codes.get(rc, "Connection refused – unknown error code {}".format(rc)))
 
-    def on_disconnect(self, client, userdata, rc):
-        logging.warning("Disconnected from broker with code ({})".format(rc))
+    def on_disconnect(self, client, userdata, rc, properties=None):
+        logging.warning("Disconnected from broker with code ({})".format(self.__reason(rc)))
         self.connected_flag = False
+        if self.disconnected_callback:
+            logging.debug("Calling the 'disconnected_callback'")
+            self.disconnected_callback()
 
     def on_message(self, client, userdata, message):
         logging.info("\nTOPIC: {}".format(message.topic))
@@ -84,11 +249,13 @@ class Myqtt(object):
 
     def on_publish(self, client, userdata, mid):
         logging.debug("Published Message ID: {}".format(mid))
+        if self.policies:
+            self.__send_queued(self.policies.acknowledged(mid))
 
-    def on_subscribe(self, client, userdata, mid, granted_qos):
+    def on_subscribe(self, client, userdata, mid, granted_qos, properties=None):
         logging.info("Subscribed: {}".format(mid))
 
-    def on_unsubscribe(self, client, userdata, mid):
+    def on_unsubscribe(self, client, userdata, mid, *args):
         logging.debug("Unsubscribe return code ({})".format(mid))
 
     def on_log(self, client, userdata, level, buf):
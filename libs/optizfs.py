@@ -1,40 +1,90 @@
-import zfslib as zfs
+import subprocess, threading, time
 import logging
 
+
+class ZPool(object):
+    __slots__ = ("name", "size", "allocated", "capacity", "health", "mountpoint", "mounted")
+
+    def __init__(self, name, size, allocated, capacity, health):
+        self.name = name
+        self.size = size
+        self.allocated = allocated
+        self.capacity = capacity
+        self.health = health
+        self.mountpoint = None
+        self.mounted = None
+
+
 class OptiZFS(object):
-    def __init__(self, host="localhost"):
+    """Long-lived view of the host's ZFS pools.
+
+    All pool properties come from a single ``zpool list -Hp`` and all
+    dataset mountpoints from a single ``zfs list -Hp``. The results are
+    cached for ``ttl`` seconds and indexed by mountpoint, so looking up a
+    mount costs a dict access instead of a subprocess.
+    """
+
+    def __init__(self, host="localhost", ttl=60):
         self.host = host
+        self.ttl = ttl
         self.pools = {}
+        self.mountpoints = {}
+        self.fetched = None
+        self.lock = threading.Lock()
 
-        conn = zfs.Connection(host)
-        self.poolset = conn.load_poolset()
+    def __run(self, args):
+        if self.host not in ("localhost", "127.0.0.1"):
+            args = ["ssh", self.host] + args
+        output = subprocess.check_output(args, stderr=subprocess.DEVNULL, timeout=30)
+        return [line.split("\t") for line in output.decode("utf-8", "replace").splitlines() if line]
 
-    def __list_pools(self):
-        for k, v in self.poolset._pools.items():
-            self.pools[v.name] = v
+    def refresh(self, force=False):
+        with self.lock:
+            if not force and self.fetched is not None and time.monotonic() - self.fetched < self.ttl:
+                return
+            pools = {}
+            for name, size, allocated, capacity, health in self.__run(
+                    ["zpool", "list", "-Hp", "-o", "name,size,allocated,capacity,health"]):
+                pools[name] = ZPool(name, float(size), float(allocated), capacity, health)
+            mountpoints = {}
+            for name, mountpoint, mounted in self.__run(
+                    ["zfs", "list", "-Hp", "-t", "filesystem", "-o", "name,mountpoint,mounted"]):
+                # a pool is represented by its root dataset
+                pool = pools.get(name)
+                if pool is None:
+                    continue
+                pool.mountpoint = mountpoint
+                pool.mounted = mounted
+                if mountpoint.startswith("/"):
+                    mountpoints[mountpoint] = pool
+            self.pools = pools
+            self.mountpoints = mountpoints
+            self.fetched = time.monotonic()
+            logging.debug("zfs pools: {}".format(list(pools)))
 
     def get_pools(self):
-        self.__list_pools()
+        self.refresh()
         return self.pools
 
-    def __get_property(self, pool, property):
-        return pool.get_property(property)
+    def get_pool_for_mountpoint(self, mountpoint):
+        self.refresh()
+        return self.mountpoints.get(mountpoint)
 
     def get_capacity(self, pool):
-        return self.__get_property(pool, "capacity")
+        return pool.capacity
 
     def get_storage_percent(self, pool):
-        total = float(self.__get_property(pool, "size"))
-        used = float(self.__get_property(pool, "allocated"))
-        percent = round((used * 100) / total, 1)
-        logging.debug("######################################## \n\n\ntotal: {}\nused: {}\npercent: {}\n\n\n".format(total, used, percent))
+        if not pool.size:
+            return 0.0
+        percent = round((pool.allocated * 100) / pool.size, 1)
+        logging.debug("{}: total: {} used: {} percent: {}".format(pool.name, pool.size, pool.allocated, percent))
         return float(percent)
 
     def get_mounted(self, pool):
-        return self.__get_property(pool, "mounted")
+        return pool.mounted
 
     def get_mountpoint(self, pool):
-        return self.__get_property(pool, "mountpoint")
+        return pool.mountpoint
 
 
 # ##################### TESTING
@@ -44,5 +94,5 @@ class OptiZFS(object):
 #     print("Name: ", k)
 #     print("Mountpoint: ", z.get_mountpoint(v))
 #     print("Mounted: ", z.get_mounted(v))
-#     print("Storage: ", z.get_storage(v))
-#     print("\n")
\ No newline at end of file
+#     print("Storage: ", z.get_storage_percent(v))
+#     print("\n")
@@ -1,6 +1,6 @@
 from dotenv import load_dotenv
 from libs.system_info import get_hostname, Platform
-import os, logging
+import os, re, ast, copy, fnmatch, logging
 
 
 def _getenv_bool(key, default=False):
@@ -28,6 +28,131 @@ def _getenv_int(key, default):
         return default
 
 
+def _parse_deadbands(value):
+    """Turn DEADBAND, e.g. {"cpu": 2, "memory": "5%"}, into {topic: (absolute, percent)}."""
+    if not value:
+        return {}
+    try:
+        entries = ast.literal_eval(value)
+    except (ValueError, SyntaxError) as e:
+        raise ValueError("Config: DEADBAND must be a dict, e.g. {{\"cpu\": 2, \"memory\": \"5%\"}}: {}".format(e))
+    if not isinstance(entries, dict):
+        raise ValueError("Config: DEADBAND must be a dict, got {!r}".format(value))
+    deadbands = {}
+    for topic, band in entries.items():
+        band = str(band).strip()
+        try:
+            if band.endswith("%"):
+                deadbands[str(topic).strip("/")] = (0.0, float(band[:-1]))
+            else:
+                deadbands[str(topic).strip("/")] = (float(band), 0.0)
+        except ValueError:
+            raise ValueError("Config: DEADBAND for '{}' must be a number or a percentage, got {!r}".format(topic, band))
+    return deadbands
+
+
+def _parse_policies(value):
+    """Turn PUBLISH_POLICY, e.g. {"disks/mount": {"qos": 1, "retain": True}}, into {family: settings}."""
+    if not value:
+        return {}
+    try:
+        entries = ast.literal_eval(value)
+    except (ValueError, SyntaxError) as e:
+        raise ValueError("Config: PUBLISH_POLICY must be a dict of dicts, e.g. {{\"cpu\": {{\"qos\": 0}}}}: {}".format(e))
+    if not isinstance(entries, dict) or not all(isinstance(v, dict) for v in entries.values()):
+        raise ValueError("Config: PUBLISH_POLICY must be a dict of dicts, got {!r}".format(value))
+    policies = {}
+    for family, settings in entries.items():
+        unknown = set(settings) - {"qos", "retain", "expiry", "inflight"}
+        if unknown:
+            raise ValueError("Config: PUBLISH_POLICY for '{}' has unknown setting(s) {}".format(family, sorted(unknown)))
+        if settings.get("qos") not in (None, 0, 1, 2):
+            raise ValueError("Config: PUBLISH_POLICY qos for '{}' must be 0, 1 or 2".format(family))
+        if "retain" in settings and not isinstance(settings["retain"], bool):
+            raise ValueError("Config: PUBLISH_POLICY retain for '{}' must be True or False".format(family))
+        for key in ("expiry", "inflight"):
+            if key in settings and (not isinstance(settings[key], (int, float)) or settings[key] <= 0):
+                raise ValueError("Config: PUBLISH_POLICY {} for '{}' must be a positive number".format(key, family))
+        policies[str(family).strip("/")] = settings
+    return policies
+
+
+def _parse_nodes(value):
+    """Turn PVE_NODES, e.g. ["pve1", "pve2"], into a list of node names."""
+    if not value:
+        return []
+    try:
+        nodes = ast.literal_eval(value)
+    except (ValueError, SyntaxError) as e:
+        raise ValueError("Config: PVE_NODES must be a list, e.g. [\"pve1\", \"pve2\"]: {}".format(e))
+    if isinstance(nodes, str):
+        nodes = [nodes]
+    if not isinstance(nodes, (list, tuple)):
+        raise ValueError("Config: PVE_NODES must be a list, got {!r}".format(value))
+    return [str(node).strip() for node in nodes if str(node).strip()]
+
+
+class StorageFilter(object):
+    """STORAGE_INCLUDE / STORAGE_EXCLUDE compiled once at start-up.
+
+    Each setting is a list literal. Plain entries are disk labels and are
+    matched case-insensitively through a frozenset. Entries containing
+    ``*``, ``?`` or ``[`` are globs and entries starting with ``re:`` are
+    regular expressions; both are folded into one compiled pattern and
+    matched against the label and the mountpoint, so
+    ``/var/lib/docker/overlay2/*`` drops every overlay mount at once.
+    The include list takes precedence over the exclude list.
+    """
+
+    def __init__(self, include=None, exclude=None):
+        self.include = self.__compile("STORAGE_INCLUDE", include)
+        self.exclude = self.__compile("STORAGE_EXCLUDE", exclude)
+
+    def __compile(self, key, value):
+        if not value:
+            return None
+        try:
+            entries = ast.literal_eval(value)
+        except (ValueError, SyntaxError) as e:
+            raise ValueError("Config: {} must be a list, e.g. [\"sysroot\", \"data\"]: {}".format(key, e))
+        if isinstance(entries, str):
+            entries = [entries]
+        if not isinstance(entries, (list, tuple, set)):
+            raise ValueError("Config: {} must be a list, got {!r}".format(key, value))
+        names, patterns = set(), []
+        for entry in entries:
+            entry = str(entry)
+            if entry.startswith("re:"):
+                patterns.append(entry[3:])
+            elif any(c in entry for c in "*?["):
+                patterns.append(fnmatch.translate(entry))
+            else:
+                names.add(entry.lower())
+        try:
+            pattern = re.compile("|".join("(?:{})".format(p) for p in patterns), re.IGNORECASE) if patterns else None
+        except re.error as e:
+            raise ValueError("Config: {} has an invalid pattern: {}".format(key, e))
+        return frozenset(names), pattern
+
+    def __matches(self, compiled, label, path):
+        names, pattern = compiled
+        if label.lower() in names:
+            return True
+        if pattern is not None:
+            return bool(pattern.match(label) or (path and pattern.match(path)))
+        return False
+
+    def allowed(self, label, path=None):
+        if self.include is not None:
+            return self.__matches(self.include, label, path)
+        if self.exclude is not None:
+            return not self.__matches(self.exclude, label, path)
+        return True
+
+    def __repr__(self):
+        return "StorageFilter(include={}, exclude={})".format(self.include, self.exclude)
+
+
 class Parser(object):
 
     def __init__(self, config):
@@ -38,25 +163,65 @@ class Parser(object):
         self.OLD_LOG_FILENAME = os.getenv("OLD_LOG_FILENAME", default="old_system2mqtt.log")
         self.MQTT_BASE_TOPIC = os.getenv("MQTT_BASE_TOPIC", default="system2mqtt/{}".format(self.COMPUTER_NAME))
         self.PUBLISH_PERIOD = _getenv_int("PUBLISH_PERIOD", default=60)
+        self.CPU_USAGE_PERIOD = _getenv_int("CPU_USAGE_PERIOD", default=None)
+        self.CPU_TEMP_PERIOD = _getenv_int("CPU_TEMP_PERIOD", default=None)
+        self.MEMORY_PERIOD = _getenv_int("MEMORY_PERIOD", default=None)
+        self.DISK_SPACE_PERIOD = _getenv_int("DISK_SPACE_PERIOD", default=None)
+        self.MOUNT_STATE_PERIOD = _getenv_int("MOUNT_STATE_PERIOD", default=None)
+        self.FAN_SPEED_PERIOD = _getenv_int("FAN_SPEED_PERIOD", default=None)
+        self.HDD_TEMP_PERIOD = _getenv_int("HDD_TEMP_PERIOD", default=None)
+        self.FANS_PERIOD = _getenv_int("FANS_PERIOD", default=None)
+        self.SENSOR_RESCAN_PERIOD = _getenv_int("SENSOR_RESCAN_PERIOD", default=600)
+        self.COLLECTOR_WORKERS = _getenv_int("COLLECTOR_WORKERS", default=4)
+        self.SMART_CONCURRENCY = _getenv_int("SMART_CONCURRENCY", default=4)
+        self.COLLECTOR_TIMEOUT = _getenv_int("COLLECTOR_TIMEOUT", default=30)
+        self.ASYNC_MODE = _getenv_bool("ASYNC_MODE", default=False)
         self.DEBUG_LOG = _getenv_bool("DEBUG_LOG", default=False)
         self.PROCPATH = os.getenv("PROCPATH", default="/proc")
+        self.CPU_DETAIL = _getenv_bool("CPU_DETAIL", default=False)
         self.ARGON = _getenv_bool("ARGON", default=False)
         self.STORAGE_INCLUDE = os.getenv("STORAGE_INCLUDE", default=False)
         self.STORAGE_EXCLUDE = os.getenv("STORAGE_EXCLUDE", default=False)
+        self.STORAGE_FILTER = StorageFilter(self.STORAGE_INCLUDE, self.STORAGE_EXCLUDE)
+        self.ZFS_CACHE_TTL = _getenv_int("ZFS_CACHE_TTL", default=60)
         self.PVE_SYSTEM = _getenv_bool("PVE_SYSTEM", default=False)
         self.PVE_NODE_NAME = os.getenv("PVE_NODE_NAME", default="pve")
         self.PVE_HOST = os.getenv("PVE_HOST", default="localhost")
         self.PVE_USER = os.getenv("PVE_USER", default="root@pam")
+        self.PVE_NODES = _parse_nodes(os.getenv("PVE_NODES", default=False))
+        self.PVE_NODE_BASE_TOPIC = os.getenv("PVE_NODE_BASE_TOPIC", default="system2mqtt/{}")
         self.PVE_PASSWORD = os.getenv("PVE_PASSWORD")
         self.MQTT_HOST = os.getenv("MQTT_HOST", default="localhost")
         self.MQTT_PORT = _getenv_int("MQTT_PORT", default=1883)
         self.MQTT_USER = os.getenv("MQTT_USER", default=None)
         self.MQTT_PASSWORD = os.getenv("MQTT_PASSWORD", default=None)
+        self.MQTT_V5 = _getenv_bool("MQTT_V5", default=False)
+        self.MQTT_SESSION_EXPIRY = _getenv_int("MQTT_SESSION_EXPIRY", default=3600)
+        self.MQTT_MESSAGE_EXPIRY = _getenv_int("MQTT_MESSAGE_EXPIRY", default=None)
         self.MACOS = _getenv_bool("MACOS", default=False)
         self.CALLBACKS = os.getenv("CALLBACKS", default={})
         self.USER_CALLBACKS = _getenv_bool("USER_CALLBACKS", default=False)
         self.HA_DISCOVERY = _getenv_bool("HA_DISCOVERY", default=False)
         self.HA_DISCOVERY_BASE = os.getenv("HA_DISCOVERY_BASE", default="homeassistant")
+        self.HA_DISCOVERY_RATE = _getenv_int("HA_DISCOVERY_RATE", default=20)
+        self.HA_DISCOVERY_COMPACT = _getenv_bool("HA_DISCOVERY_COMPACT", default=False)
+        self.HA_DISCOVERY_DEVICE = _getenv_bool("HA_DISCOVERY_DEVICE", default=False)
+        self.AVAILABILITY_HEARTBEAT = _getenv_int("AVAILABILITY_HEARTBEAT", default=0)
+        self.PUBLISH_CHANGES_ONLY = _getenv_bool("PUBLISH_CHANGES_ONLY", default=False)
+        self.DEADBAND = os.getenv("DEADBAND", default=False)
+        self.DEADBANDS = _parse_deadbands(self.DEADBAND)
+        self.MAX_SILENCE = _getenv_int("MAX_SILENCE", default=300)
+        self.STATE_JSON = _getenv_bool("STATE_JSON", default=False)
+        self.PAYLOAD_CODEC = os.getenv("PAYLOAD_CODEC", default="text").strip().lower()
+        self.PAYLOAD_COMPRESS_MIN = _getenv_int("PAYLOAD_COMPRESS_MIN", default=0)
+        self.PUBLISH_POLICY = os.getenv("PUBLISH_POLICY", default=False)
+        self.PUBLISH_POLICIES = _parse_policies(self.PUBLISH_POLICY)
+        self.SPOOL = _getenv_bool("SPOOL", default=False)
+        self.SPOOL_DIR = os.getenv("SPOOL_DIR", default="./spool")
+        self.SPOOL_MAX_MB = _getenv_int("SPOOL_MAX_MB", default=50)
+        self.SPOOL_RETENTION = _getenv_int("SPOOL_RETENTION", default=86400)
+        self.SPOOL_DOWNSAMPLE = _getenv_int("SPOOL_DOWNSAMPLE", default=60)
+        self.SPOOL_DRAIN_RATE = _getenv_int("SPOOL_DRAIN_RATE", default=50)
 
         if Platform == "Darwin":
             self.MACOS = True
@@ -64,6 +229,24 @@ class Parser(object):
         else:
             self.MACOS = False
 
+        # Home Assistant reads the telemetry topics as plain text
+        if self.HA_DISCOVERY and self.PAYLOAD_CODEC != "text":
+            raise ValueError("Config: PAYLOAD_CODEC {} cannot be used with HA_DISCOVERY".format(self.PAYLOAD_CODEC))
+        if self.HA_DISCOVERY and self.PAYLOAD_COMPRESS_MIN:
+            raise ValueError("Config: PAYLOAD_COMPRESS_MIN cannot be used with HA_DISCOVERY")
+        # only MQTT 5 tells consumers per message how a payload was encoded
+        if self.PAYLOAD_COMPRESS_MIN and not self.MQTT_V5:
+            raise ValueError("Config: PAYLOAD_COMPRESS_MIN needs MQTT_V5=True to mark compressed payloads")
+
+    def for_node(self, node):
+        """A copy of this config for one of PVE_NODES."""
+        config = copy.copy(self)
+        config.COMPUTER_NAME = node
+        config.PVE_NODE_NAME = node
+        config.MQTT_BASE_TOPIC = self.PVE_NODE_BASE_TOPIC.format(node)
+        config.SPOOL_DIR = os.path.join(self.SPOOL_DIR, node)
+        return config
+
     def print_config(self):
         conf = "\n###############################################\n\nUsing Current Config\n\n"
         for k, v in self.__dict__.items():
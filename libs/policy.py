@@ -0,0 +1,124 @@
+import time, threading, logging
+from collections import deque, OrderedDict
+
+
+class Policy(object):
+    """Delivery settings for one topic family.
+
+    ``qos`` and ``retain`` override what the caller asked for when set.
+    ``inflight`` caps how many QoS 1/2 messages of the family may wait for
+    an acknowledgement at once; publishes beyond that are queued and sent
+    as acknowledgements come in. ``expiry`` (seconds) drops queued
+    messages that waited too long.
+    """
+
+    __slots__ = ("family", "qos", "retain", "expiry", "inflight", "pending", "queue")
+
+    def __init__(self, family, qos=None, retain=None, expiry=None, inflight=None):
+        self.family = family
+        self.qos = qos
+        self.retain = retain
+        self.expiry = expiry
+        self.inflight = inflight
+        self.pending = 0
+        self.queue = deque()
+
+
+class PolicyTable(object):
+    """PUBLISH_POLICY, looked up by topic family.
+
+    Families are topics below the base topic (``cpu``, ``disks/mount``) or
+    full topics outside it (``homeassistant``); the longest matching prefix
+    wins. The lookup is cached per topic. With PVE_NODES every node's base
+    topic is added, so families apply below each of them.
+    """
+
+    DEFAULT = Policy(None)
+
+    def __init__(self, base_topic, policies=None):
+        self.prefixes = [base_topic.rstrip("/") + "/"]
+        self.policies = {family: Policy(family, **settings) for family, settings in (policies or {}).items()}
+        self.families = sorted(self.policies, key=len, reverse=True)
+        self.cache = {}
+        self.mids = {}
+        # acknowledgements that arrived before sent() recorded the mid
+        self.early = OrderedDict()
+        self.lock = threading.Lock()
+
+    def add_base_topic(self, base_topic):
+        self.prefixes.append(base_topic.rstrip("/") + "/")
+        self.cache = {}
+
+    def lookup(self, topic):
+        policy = self.cache.get(topic)
+        if policy is None:
+            name = topic
+            for prefix in self.prefixes:
+                if topic.startswith(prefix):
+                    name = topic[len(prefix):]
+                    break
+            policy = self.DEFAULT
+            for family in self.families:
+                if name == family or name.startswith(family + "/"):
+                    policy = self.policies[family]
+                    break
+            self.cache[topic] = policy
+        return policy
+
+    def admit(self, policy, qos, message):
+        """Return True if the message can be sent now, otherwise queue it."""
+        if not qos or not policy.inflight:
+            return True
+        with self.lock:
+            if policy.pending < policy.inflight:
+                policy.pending += 1
+                return True
+            policy.queue.append((time.monotonic(), message))
+            logging.debug("'{}': {} in flight, queued ({} waiting)".format(policy.family, policy.pending, len(policy.queue)))
+            return False
+
+    def sent(self, policy, qos, mid):
+        """Record the mid of an admitted message; returns queued messages if it was already acknowledged."""
+        if not qos or not policy.inflight:
+            return []
+        with self.lock:
+            if self.early.pop(mid, None) is None:
+                self.mids[mid] = policy
+                return []
+            policy.pending -= 1
+            return self.__dequeue(policy)
+
+    def acknowledged(self, mid):
+        """Release the slot held by ``mid`` and return the queued messages that may now be sent."""
+        with self.lock:
+            policy = self.mids.pop(mid, None)
+            if policy is None:
+                self.early[mid] = True
+                if len(self.early) > 256:
+                    self.early.popitem(last=False)
+                return []
+            policy.pending -= 1
+            return self.__dequeue(policy)
+
+    def __dequeue(self, policy):
+        ready = []
+        now = time.monotonic()
+        while policy.queue and policy.pending < policy.inflight:
+            queued, message = policy.queue.popleft()
+            if policy.expiry and now - queued > policy.expiry:
+                logging.debug("'{}': dropping message queued {:.0f}s ago".format(policy.family, now - queued))
+                continue
+            policy.pending += 1
+            ready.append(message)
+        return ready
+
+    def reset(self):
+        """Forget unacknowledged messages, e.g. after a new connection, and return what is queued."""
+        with self.lock:
+            self.mids = {}
+            self.early = OrderedDict()
+            ready = []
+            for policy in self.policies.values():
+                policy.pending = 0
+                ready += self.__dequeue(policy)
+            return ready
@@ -0,0 +1,108 @@
+import os, logging
+
+
+class PinnedFile(object):
+    """A /proc or /sys file kept open and reread with pread at offset 0.
+
+    Procfs and sysfs regenerate the content on every read from offset 0, so
+    the descriptor never has to be reopened. Reads go into a buffer that is
+    reused between calls and grown if the file outgrows it.
+    """
+
+    __slots__ = ("path", "fd", "buffer")
+
+    def __init__(self, path, size=4096):
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY)
+        self.buffer = bytearray(size)
+
+    def read(self):
+        while True:
+            if hasattr(os, "preadv"):
+                n = os.preadv(self.fd, [self.buffer], 0)
+            else:
+                data = os.pread(self.fd, len(self.buffer), 0)
+                n = len(data)
+                self.buffer[:n] = data
+            if n < len(self.buffer):
+                return bytes(memoryview(self.buffer)[:n])
+            self.buffer = bytearray(len(self.buffer) * 2)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class MemInfo(object):
+    __slots__ = ("total", "available", "free", "used", "percent")
+
+    def __init__(self, total, available, free):
+        self.total = total
+        self.available = available
+        self.free = free
+        self.used = total - available
+        self.percent = round(self.used * 100.0 / total, 1) if total else 0.0
+
+
+class LoadAvg(object):
+    __slots__ = ("load1", "load5", "load15")
+
+    def __init__(self, load1, load5, load15):
+        self.load1 = load1
+        self.load5 = load5
+        self.load15 = load15
+
+
+class ProcReader(object):
+    """Fast-path readers for the /proc files sampled every tick.
+
+    Files are opened on first use and kept open. Only the fields that are
+    published are parsed.
+    """
+
+    MEMINFO_FIELDS = {b"MemTotal:": "total", b"MemFree:": "free", b"MemAvailable:": "available"}
+
+    def __init__(self, procpath="/proc"):
+        self.procpath = procpath or "/proc"
+        self.files = {}
+
+    def pinned(self, name):
+        pinned = self.files.get(name)
+        if pinned is None:
+            path = os.path.join(self.procpath, name)
+            logging.debug("Pinning {}".format(path))
+            pinned = self.files[name] = PinnedFile(path)
+        return pinned
+
+    def stat_cpu(self):
+        """Return {"cpu": [...], "cpu0": [...], ...} with the first eight counters of each cpu line."""
+        counters = {}
+        for line in self.pinned("stat").read().split(b"\n"):
+            if not line.startswith(b"cpu"):
+                break
+            parts = line.split()
+            counters[parts[0].decode()] = [int(v) for v in parts[1:9]]
+        return counters
+
+    def meminfo(self):
+        values = {}
+        for line in self.pinned("meminfo").read().split(b"\n"):
+            key, _, rest = line.partition(b" ")
+            field = self.MEMINFO_FIELDS.get(key)
+            if field:
+                values[field] = int(rest.split()[0]) * 1024
+                if len(values) == len(self.MEMINFO_FIELDS):
+                    break
+        # kernels before 3.14 have no MemAvailable
+        available = values.get("available", values.get("free", 0))
+        return MemInfo(values.get("total", 0), available, values.get("free", 0))
+
+    def loadavg(self):
+        parts = self.pinned("loadavg").read().split()
+        return LoadAvg(float(parts[0]), float(parts[1]), float(parts[2]))
+
+    def close(self):
+        for pinned in self.files.values():
+            pinned.close()
+        self.files = {}
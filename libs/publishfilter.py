@@ -0,0 +1,61 @@
+import time, threading, logging
+
+
+class PublishFilter(object):
+    """Drops metric publishes whose value did not change.
+
+    The last payload sent on each topic is remembered. A new payload is
+    sent if it differs from it, or, for numbers, if it moved further than
+    the deadband for that topic. Deadbands are keyed by topic below the
+    base topic, and the longest matching prefix wins, e.g. ``cpu`` or
+    ``disks/storage``. Each deadband is ``(absolute, percent of the last
+    value)``; the larger of the two applies. Every topic is sent again
+    after ``max_silence`` seconds even if it did not change, so
+    Home Assistant's ``expire_after`` keeps working.
+    """
+
+    def __init__(self, base_topic, deadbands=None, max_silence=300):
+        self.prefix = base_topic.rstrip("/") + "/"
+        self.deadbands = deadbands or {}
+        self.max_silence = max_silence
+        self.last = {}
+        self.bands = {}
+        self.lock = threading.Lock()
+
+    def __deadband(self, topic):
+        band = self.bands.get(topic)
+        if band is None:
+            name = topic[len(self.prefix):] if topic.startswith(self.prefix) else topic
+            band = (0.0, 0.0)
+            for key in sorted(self.deadbands, key=len, reverse=True):
+                if name == key or name.startswith(key + "/"):
+                    band = self.deadbands[key]
+                    break
+            self.bands[topic] = band
+        return band
+
+    def __changed(self, topic, old, new):
+        if old == new:
+            return False
+        try:
+            old, new = float(old), float(new)
+        except (TypeError, ValueError):
+            return True
+        absolute, relative = self.__deadband(topic)
+        return abs(new - old) > max(absolute, abs(old) * relative / 100.0)
+
+    def should_publish(self, topic, payload):
+        now = time.monotonic()
+        with self.lock:
+            last = self.last.get(topic)
+            if (last is not None and now - last[1] < self.max_silence
+                    and not self.__changed(topic, last[0], payload)):
+                logging.debug("{}: unchanged, not publishing".format(topic))
+                return False
+            self.last[topic] = (payload, now)
+            return True
+
+    def reset(self):
+        """Forget what was sent, e.g. after reconnecting to the broker."""
+        with self.lock:
+            self.last = {}
@@ -0,0 +1,268 @@
+import logging, time, asyncio, threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Job(object):
+    """A single collector and the cadence it runs at.
+
+    An ``interval`` of None means the job follows the scheduler's default
+    interval (PUBLISH_PERIOD), so runtime changes to the publish period
+    only affect collectors that were not given their own period.
+    """
+
+    def __init__(self, name, func, interval=None, timeout=None):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.timeout = timeout
+        self.next_run = time.monotonic()
+        self.lag = 0.0
+        self.overruns = 0
+        self.runs = 0
+        self.future = None
+        self.started = None
+        self.timed_out = False
+        self.status = None
+        self.in_flight = False
+
+
+class Scheduler(object):
+    """Runs each registered collector on its own interval.
+
+    Deadlines are kept on the monotonic clock and advanced by whole
+    intervals, so the time a collector takes to run does not push later
+    ticks back. When a collector runs past one or more of its deadlines
+    those ticks are skipped and counted as overruns rather than queued up.
+    Ticks missed while the loop itself was not running (e.g. while
+    disconnected) are skipped without counting; ``resync`` moves the
+    deadlines of idle jobs up to now when the loop resumes.
+
+    Collectors run concurrently on a bounded thread pool. A collector that
+    exceeds its timeout is reported through ``status_callback`` and is not
+    resubmitted until its stuck run finally returns, so one hung source
+    can hold at most one worker.
+
+    ``idle_callback`` is called once no collector is left running (stuck
+    collectors past their timeout do not count), i.e. when everything
+    started for a tick has delivered its values.
+    """
+
+    def __init__(self, default_interval, workers=4, timeout=30):
+        self.default_interval = default_interval
+        self.timeout = timeout
+        self.jobs = []
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.overruns = 0
+        self.status_callback = None
+        self.idle_callback = None
+        self.running = 0
+        self.running_lock = threading.Lock()
+        self.loop = None
+        self.wakeup = None
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="s2m-collector")
+
+    def add(self, name, func, interval=None, timeout=None):
+        logging.debug("Scheduling '{}' every {} seconds".format(name, interval or "PUBLISH_PERIOD"))
+        job = Job(name, func, interval, timeout)
+        self.jobs.append(job)
+        return job
+
+    def get_interval(self, job):
+        if job.interval:
+            return int(job.interval)
+        return int(self.default_interval)
+
+    def get_timeout(self, job):
+        return job.timeout or self.timeout
+
+    def due(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        return [job for job in self.jobs if job.next_run <= now]
+
+    def start_job(self, job, now=None):
+        """Record how late the job is starting and move it to its next deadline."""
+        if now is None:
+            now = time.monotonic()
+        job.lag = max(0.0, now - job.next_run)
+        self.last_lag = job.lag
+        self.max_lag = max(self.max_lag, job.lag)
+        missed = self.__advance(job, now)
+        if missed:
+            # the job was idle, so the loop was late rather than the collector
+            logging.debug("Collector '{}' skipped {} tick(s)".format(job.name, missed))
+
+    def resync(self, now=None):
+        """Make idle jobs due now instead of late, after the loop was paused (e.g. disconnected)."""
+        if now is None:
+            now = time.monotonic()
+        for job in self.jobs:
+            if job.future is None and job.next_run < now:
+                job.next_run = now
+
+    def __advance(self, job, now):
+        """Move the job's deadline past ``now`` in whole intervals, returning how many ticks were missed."""
+        interval = self.get_interval(job)
+        job.next_run += interval
+        missed = 0
+        if job.next_run <= now:
+            missed = int((now - job.next_run) // interval) + 1
+            job.next_run += missed * interval
+        return missed
+
+    def __count_overruns(self, job, missed):
+        job.overruns += missed
+        self.overruns += missed
+        logging.warning("Collector '{}' overran {} tick(s), skipping them".format(job.name, missed))
+
+    def __set_status(self, job, status):
+        if status == job.status:
+            return
+        job.status = status
+        if self.status_callback:
+            try:
+                self.status_callback(job)
+            except Exception as e:
+                logging.error(e, exc_info=True)
+
+    def __begin(self, job):
+        job.in_flight = True
+        self.hold()
+
+    def __end(self, job):
+        """Stop counting the job as running, called when it returns or times out."""
+        with self.running_lock:
+            if not job.in_flight:
+                return
+            job.in_flight = False
+        self.release()
+
+    def hold(self):
+        """Keep idle_callback back, e.g. while the jobs of a tick are being started."""
+        with self.running_lock:
+            self.running += 1
+
+    def release(self):
+        with self.running_lock:
+            self.running -= 1
+            idle = self.running == 0
+        if idle and self.idle_callback:
+            try:
+                self.idle_callback()
+            except Exception as e:
+                logging.error(e, exc_info=True)
+
+    def __execute(self, job, *args):
+        try:
+            job.func(*args)
+        except Exception as e:
+            logging.error("Collector '{}' failed: {}".format(job.name, e), exc_info=True)
+            return "error"
+        finally:
+            job.runs += 1
+            self.__end(job)
+        return "ok"
+
+    def reap(self, now=None):
+        """Collect finished runs and flag the ones that have exceeded their timeout."""
+        if now is None:
+            now = time.monotonic()
+        for job in self.jobs:
+            if job.future is None:
+                continue
+            if job.future.done():
+                if job.timed_out:
+                    logging.info("Collector '{}' returned after timing out".format(job.name))
+                status = job.future.result() if not job.future.cancelled() else "error"
+                job.future = None
+                job.started = None
+                job.timed_out = False
+                self.__set_status(job, status)
+            elif job.started is not None and not job.timed_out and now - job.started > self.get_timeout(job):
+                job.timed_out = True
+                logging.warning("Collector '{}' timed out after {} seconds".format(job.name, self.get_timeout(job)))
+                self.__set_status(job, "timeout")
+                self.__end(job)
+
+    def run_job(self, job, *args):
+        now = time.monotonic()
+        if job.future is not None:
+            # still busy with a previous tick, skip this one
+            self.__count_overruns(job, self.__advance(job, now) + 1)
+            return
+        self.start_job(job, now)
+        self.__begin(job)
+        # the timeout runs from submission, so a job queued behind hung ones times out too
+        job.started = now
+        job.future = self.executor.submit(self.__execute, job, *args)
+
+    def run_pending(self, *args):
+        self.reap()
+        for job in self.due():
+            logging.debug("Running collector '{}'".format(job.name))
+            self.run_job(job, *args)
+
+    def bind_loop(self, loop):
+        """Run collectors from the given asyncio loop instead of run_pending."""
+        self.loop = loop
+        self.wakeup = asyncio.Event()
+
+    async def __watch_async(self, job, *args):
+        run = self.loop.run_in_executor(self.executor, self.__execute, job, *args)
+        try:
+            status = await asyncio.wait_for(asyncio.shield(run), self.get_timeout(job))
+        except asyncio.TimeoutError:
+            job.timed_out = True
+            logging.warning("Collector '{}' timed out after {} seconds".format(job.name, self.get_timeout(job)))
+            self.__set_status(job, "timeout")
+            self.__end(job)
+            status = await run
+            logging.info("Collector '{}' returned after timing out".format(job.name))
+        job.future = None
+        job.started = None
+        job.timed_out = False
+        self.__set_status(job, status)
+
+    def run_job_async(self, job, *args):
+        """Asyncio counterpart of run_job, must be called from the event loop."""
+        now = time.monotonic()
+        if job.future is not None:
+            self.__count_overruns(job, self.__advance(job, now) + 1)
+            return
+        self.start_job(job, now)
+        self.__begin(job)
+        job.started = now
+        job.future = self.loop.create_task(self.__watch_async(job, *args))
+
+    async def sleep_async(self):
+        """Sleep until the next deadline or until wake() is called."""
+        self.wakeup.clear()
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), self.seconds_until_next())
+        except asyncio.TimeoutError:
+            pass
+
+    def wake(self):
+        """Make sleep_async return early, e.g. after the publish period changed. Safe from any thread."""
+        if self.loop is not None and self.wakeup is not None:
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+
+    def first_pass_done(self):
+        return all(job.runs or job.timed_out for job in self.jobs)
+
+    def seconds_until_next(self):
+        if not self.jobs:
+            return int(self.default_interval)
+        deadlines = [job.next_run for job in self.jobs]
+        deadlines += [job.started + self.get_timeout(job) for job in self.jobs
+                      if job.started is not None and not job.timed_out]
+        return max(0, min(deadlines) - time.monotonic())
+
+    def reset_max_lag(self):
+        max_lag = self.max_lag
+        self.max_lag = 0.0
+        return max_lag
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
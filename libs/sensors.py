@@ -0,0 +1,154 @@
+import os, re, time, threading, logging
+
+from libs.procfs import PinnedFile
+
+
+class Channel(object):
+    """One hwmon or thermal zone input file, kept open between reads."""
+
+    __slots__ = ("chip", "kind", "label", "path", "scale", "file")
+
+    def __init__(self, chip, kind, label, path, scale):
+        self.chip = chip
+        self.kind = kind
+        self.label = label
+        self.path = path
+        self.scale = scale
+        self.file = None
+
+    def read(self):
+        if self.file is None:
+            self.file = PinnedFile(self.path, size=64)
+        return int(self.file.read()) / self.scale
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class SensorIndex(object):
+    """Index of the sensor files under /sys/class/hwmon and /sys/class/thermal.
+
+    Discovery walks sysfs once and records exactly which input files exist
+    for each chip, so a reading only touches the few files that feed the
+    published metrics. The index is rebuilt when a hwmon device appears or
+    disappears (a single directory listing per read), when a file stops
+    being readable, or every ``rescan_period`` seconds.
+    """
+
+    # <kind><n>_input files and the divisor that turns them into natural units
+    KINDS = {"temp": 1000.0, "fan": 1.0, "in": 1000.0, "curr": 1000.0, "power": 1000000.0}
+    CPU_CHIPS = ("coretemp", "cpu_thermal", "k10temp", "zenpower")
+    INPUT_FILE = re.compile(r"^(temp|fan|in|curr|power)(\d+)_input$")
+
+    def __init__(self, sysfs="/sys", rescan_period=600):
+        self.hwmon_dir = os.path.join(sysfs, "class", "hwmon")
+        self.thermal_dir = os.path.join(sysfs, "class", "thermal")
+        self.rescan_period = rescan_period
+        self.channels = []
+        self.devices = None
+        self.scanned = 0
+        self.stale = True
+        self.lock = threading.RLock()
+
+    def __listdir(self, path):
+        try:
+            return sorted(os.listdir(path))
+        except OSError:
+            return []
+
+    def __read_text(self, path, default=None):
+        try:
+            with open(path, "r") as f:
+                return f.read().strip()
+        except OSError:
+            return default
+
+    def __scan_hwmon(self, device_dir):
+        chip = self.__read_text(os.path.join(device_dir, "name"))
+        if chip is None:
+            return []
+        channels = []
+        # older drivers keep their attributes under device/
+        for directory in (device_dir, os.path.join(device_dir, "device")):
+            for filename in self.__listdir(directory):
+                match = self.INPUT_FILE.match(filename)
+                if not match:
+                    continue
+                kind, number = match.groups()
+                label = self.__read_text(os.path.join(directory, "{}{}_label".format(kind, number)),
+                                         default="{}{}".format(kind, number))
+                channels.append(Channel(chip, kind, label, os.path.join(directory, filename), self.KINDS[kind]))
+        return channels
+
+    def scan(self):
+        for channel in self.channels:
+            channel.close()
+        channels = []
+        self.devices = self.__listdir(self.hwmon_dir)
+        for device in self.devices:
+            channels += self.__scan_hwmon(os.path.join(self.hwmon_dir, device))
+        chips = set(c.chip for c in channels)
+        for zone in self.__listdir(self.thermal_dir):
+            if not zone.startswith("thermal_zone"):
+                continue
+            zone_dir = os.path.join(self.thermal_dir, zone)
+            chip = self.__read_text(os.path.join(zone_dir, "type"))
+            if chip is None:
+                continue
+            chip = chip.replace("-", "_")
+            if chip in chips:
+                continue
+            channels.append(Channel(chip, "temp", zone, os.path.join(zone_dir, "temp"), 1000.0))
+        self.channels = channels
+        self.scanned = time.monotonic()
+        self.stale = False
+        logging.info("Sensor index: {} channel(s) on {}".format(len(channels), sorted(set(c.chip for c in channels))))
+
+    def refresh(self):
+        """Rescan if a device was added or removed, a read failed, or the index is old."""
+        if (self.stale or time.monotonic() - self.scanned > self.rescan_period
+                or self.__listdir(self.hwmon_dir) != self.devices):
+            self.scan()
+
+    def get_channels(self, kind, chip=None):
+        with self.lock:
+            self.refresh()
+            return [c for c in self.channels if c.kind == kind and (chip is None or c.chip == chip)]
+
+    def read(self, channels):
+        """Return {channel: value}, skipping channels that can no longer be read."""
+        values = {}
+        with self.lock:
+            for channel in channels:
+                try:
+                    values[channel] = channel.read()
+                except (OSError, ValueError) as e:
+                    logging.debug("{}: {}".format(channel.path, e))
+                    self.stale = True
+        return values
+
+    def cpu_temperature(self):
+        """Highest temperature of the first CPU chip found, or None."""
+        with self.lock:
+            for chip in self.CPU_CHIPS:
+                values = self.read(self.get_channels("temp", chip))
+                if values:
+                    return max(values.values())
+        return None
+
+    def fans(self):
+        """Return {"<chip>_<label>": rpm} for every fan input."""
+        with self.lock:
+            values = self.read(self.get_channels("fan"))
+        return {"{}_{}".format(c.chip, c.label).lower().replace(" ", "_"): int(v) for c, v in values.items()}
+
+
+_sensor_index = None
+
+def get_sensor_index(rescan_period=600):
+    global _sensor_index
+    if _sensor_index is None:
+        _sensor_index = SensorIndex(rescan_period=rescan_period)
+    return _sensor_index
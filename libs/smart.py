@@ -0,0 +1,142 @@
+import os, json, time, threading, subprocess, logging
+from concurrent.futures import ThreadPoolExecutor
+
+
+class SmartReading(object):
+    __slots__ = ("temperature", "stale", "updated")
+
+    def __init__(self, temperature, stale, updated):
+        self.temperature = temperature
+        self.stale = stale
+        self.updated = updated
+
+
+class SmartCollector(object):
+    """Disk temperatures from ``smartctl -j``.
+
+    Disks come from /sys/block, so no lsblk pipeline is needed. Every disk
+    is queried in parallel, at most ``concurrency`` smartctl processes at a
+    time. The device type that worked for a disk is remembered, so a disk
+    is only probed once; later reads go straight to ``-d <type>``. A disk
+    no device type gave a temperature for is remembered as well and left
+    alone until ``retry`` seconds have passed or the set of disks changed.
+    Disks are read with ``-n standby`` so a sleeping disk is never spun up:
+    it keeps its last known temperature, flagged as stale.
+    """
+
+    # block devices that never have SMART data
+    VIRTUAL_PREFIXES = ("loop", "ram", "zram", "dm-", "md", "sr", "nbd", "zd", "rbd", "fd")
+    # device types tried, in order, for a disk that has not been read yet
+    PROBE_TYPES = (None, "sat")
+
+    def __init__(self, smartctl="/usr/sbin/smartctl", concurrency=4, timeout=30, sysfs="/sys", retry=3600):
+        self.smartctl = smartctl
+        self.timeout = timeout
+        self.retry = retry
+        self.block_dir = os.path.join(sysfs, "block")
+        # disk -> device type, False for disks without a temperature
+        self.types = {}
+        self.known_disks = []
+        self.retry_at = 0
+        self.readings = {}
+        self.sudo = False
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="s2m-smart")
+
+    def available(self):
+        return os.path.exists(self.smartctl)
+
+    def disks(self):
+        """Physical disks listed in /sys/block."""
+        try:
+            names = sorted(os.listdir(self.block_dir))
+        except OSError:
+            return []
+        return [n for n in names
+                if not n.startswith(self.VIRTUAL_PREFIXES) and os.path.exists(os.path.join(self.block_dir, n, "device"))]
+
+    def __smartctl(self, disk, device_type):
+        args = [self.smartctl, "-j", "-n", "standby", "-A"]
+        if device_type:
+            args += ["-d", device_type]
+        args.append("/dev/" + disk)
+        if self.sudo:
+            args = ["sudo", "-n"] + args
+        result = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=self.timeout)
+        try:
+            return json.loads(result.stdout.decode("utf-8", "replace"))
+        except ValueError:
+            return {}
+
+    def __messages(self, data):
+        return " ".join(m.get("string", "") for m in data.get("smartctl", {}).get("messages", []))
+
+    def __temperature(self, data):
+        temperature = data.get("temperature", {}).get("current")
+        if temperature is None:
+            temperature = data.get("nvme_smart_health_information_log", {}).get("temperature")
+        return float(temperature) if temperature is not None else None
+
+    def __query(self, disk):
+        """Return (temperature, standby) for one disk."""
+        known = disk in self.types
+        for device_type in ((self.types[disk],) if known else self.PROBE_TYPES):
+            data = self.__smartctl(disk, device_type)
+            messages = self.__messages(data)
+            if "Permission denied" in messages and not self.sudo and os.geteuid() != 0:
+                logging.debug("smartctl: permission denied, retrying with sudo")
+                self.sudo = True
+                data = self.__smartctl(disk, device_type)
+                messages = self.__messages(data)
+            if "STANDBY" in messages or "SLEEP" in messages:
+                return None, True
+            temperature = self.__temperature(data)
+            if temperature is not None:
+                if not known:
+                    self.types[disk] = device_type or data.get("device", {}).get("type")
+                    logging.debug("{}: smartctl device type '{}'".format(disk, self.types[disk]))
+                return temperature, False
+        if not known:
+            logging.debug("{}: no temperature with any device type, skipping it".format(disk))
+            self.types[disk] = False
+        return None, False
+
+    def __read_disk(self, disk):
+        try:
+            temperature, standby = self.__query(disk)
+        except (OSError, subprocess.SubprocessError) as e:
+            logging.debug("{}: {}".format(disk, e))
+            temperature, standby = None, False
+        with self.lock:
+            if temperature is not None:
+                self.readings[disk] = SmartReading(temperature, False, time.time())
+            elif standby and disk in self.readings:
+                self.readings[disk].stale = True
+            else:
+                self.readings.pop(disk, None)
+            return self.readings.get(disk)
+
+    def read(self):
+        """Return {disk: SmartReading} for every disk with a known temperature."""
+        disks = self.disks()
+        now = time.monotonic()
+        if disks != self.known_disks or now >= self.retry_at:
+            # probe the disks without a temperature again
+            self.types = {disk: t for disk, t in self.types.items() if t is not False}
+            self.known_disks = disks
+            self.retry_at = now + self.retry
+        disks = [disk for disk in disks if self.types.get(disk) is not False]
+        results = self.executor.map(self.__read_disk, disks)
+        return {disk: reading for disk, reading in zip(disks, results) if reading is not None}
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+_smart = None
+
+def get_smart(concurrency=4):
+    global _smart
+    if _smart is None:
+        _smart = SmartCollector(concurrency=concurrency)
+    return _smart
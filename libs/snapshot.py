@@ -0,0 +1,38 @@
+import logging, threading
+
+
+class Snapshot(object):
+    """Raw host data for one scheduler tick.
+
+    Built with a mapping of source name to a function that fetches it. Each
+    source is fetched at most once, the first time a collector asks for it,
+    and every collector running in the same tick gets that same value. A
+    source that fails keeps its exception, so the other collectors see the
+    same failure instead of retrying it. Values cannot be replaced once
+    fetched.
+    """
+
+    __slots__ = ("_sources", "_values", "_errors", "_locks")
+
+    def __init__(self, sources):
+        self._sources = dict(sources)
+        self._values = {}
+        self._errors = {}
+        self._locks = {name: threading.Lock() for name in self._sources}
+
+    def get(self, name):
+        if name in self._values:
+            return self._values[name]
+        with self._locks[name]:
+            if name not in self._values and name not in self._errors:
+                logging.debug("Fetching snapshot source '{}'".format(name))
+                try:
+                    self._values[name] = self._sources[name]()
+                except Exception as e:
+                    self._errors[name] = e
+            if name in self._errors:
+                raise self._errors[name]
+            return self._values[name]
+
+    def fetched(self):
+        return tuple(self._values)
@@ -0,0 +1,138 @@
+import os, json, time, threading, logging
+
+
+class Spool(object):
+    """Disk-backed store-and-forward queue for metrics sampled while offline.
+
+    Samples are appended as JSON lines to segment files in ``directory``
+    and never rewritten. A new segment is started every ``segment_bytes``
+    and whenever a drain starts, so the drain only ever reads closed
+    segments. The spool is bounded: when it grows past ``max_bytes`` the
+    oldest segments are dropped, and samples older than ``retention``
+    seconds are skipped when draining. With ``downsample`` set, at most one
+    sample per topic is kept per window of that many seconds; windows are
+    fixed buckets of the clock, so collection jitter around a period equal
+    to ``downsample`` does not drop samples.
+
+    ``drain(publish, is_connected)`` replays the segments oldest first at
+    ``rate`` messages per second on a background thread, each with the
+    time it was sampled, and deletes a segment once it was sent. If the
+    connection drops mid-segment, that segment is sent again from the start
+    on the next drain.
+    """
+
+    PREFIX = "segment-"
+    SUFFIX = ".jsonl"
+
+    def __init__(self, directory, max_bytes=50 * 1024 * 1024, retention=86400, downsample=60,
+                 rate=50, segment_bytes=1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.retention = retention
+        self.downsample = downsample
+        self.rate = rate
+        self.segment_bytes = segment_bytes
+        self.file = None
+        self.current = None
+        self.last_sampled = {}
+        self.thread = None
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.sequence = max([self.__sequence(name) for name in self.segments()] or [0])
+
+    def __sequence(self, name):
+        return int(name[len(self.PREFIX):-len(self.SUFFIX)])
+
+    def segments(self):
+        names = [n for n in os.listdir(self.directory) if n.startswith(self.PREFIX) and n.endswith(self.SUFFIX)]
+        return sorted(names, key=self.__sequence)
+
+    def __close_segment(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            self.current = None
+
+    def __open_segment(self):
+        self.sequence += 1
+        self.current = "{}{:010d}{}".format(self.PREFIX, self.sequence, self.SUFFIX)
+        self.file = open(os.path.join(self.directory, self.current), "a")
+
+    def __enforce_limit(self):
+        sizes = [(name, os.path.getsize(os.path.join(self.directory, name))) for name in self.segments()]
+        total = sum(size for _, size in sizes)
+        # never drop the segment being written
+        for name, size in sizes[:-1]:
+            if total <= self.max_bytes:
+                break
+            logging.warning("Spool is over {} bytes, dropping {}".format(self.max_bytes, name))
+            os.remove(os.path.join(self.directory, name))
+            total -= size
+
+    def append(self, topic, payload, retain=False):
+        now = time.time()
+        with self.lock:
+            if self.downsample:
+                bucket = int(now // self.downsample)
+                if self.last_sampled.get(topic) == bucket:
+                    return
+                self.last_sampled[topic] = bucket
+            if self.file is None or self.file.tell() >= self.segment_bytes:
+                self.__close_segment()
+                self.__open_segment()
+                self.__enforce_limit()
+            self.file.write(json.dumps({"t": now, "topic": topic, "payload": payload, "retain": retain},
+                                       default=str, separators=(",", ":")) + "\n")
+            self.file.flush()
+
+    def closed_segments(self):
+        with self.lock:
+            return [name for name in self.segments() if name != self.current]
+
+    def __drain(self, publish, is_connected):
+        interval = 1.0 / self.rate if self.rate else 0
+        sent = 0
+        # segments closed while this drain runs are picked up as well
+        names = self.closed_segments()
+        while names:
+            path = os.path.join(self.directory, names[0])
+            with open(path, "r") as f:
+                for line in f:
+                    if not is_connected():
+                        logging.info("Connection lost, {} spooled message(s) sent so far".format(sent))
+                        return
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # torn write from a crash
+                        continue
+                    if self.retention and time.time() - entry["t"] > self.retention:
+                        continue
+                    publish(entry["topic"], entry["payload"], entry["t"], entry.get("retain", False))
+                    sent += 1
+                    if interval:
+                        time.sleep(interval)
+            os.remove(path)
+            names = self.closed_segments()
+        logging.info("Spool drained, {} message(s) sent".format(sent))
+
+    def __run_drain(self, publish, is_connected):
+        try:
+            self.__drain(publish, is_connected)
+        except Exception as e:
+            logging.error(e, exc_info=True)
+
+    def drain(self, publish, is_connected):
+        """Start replaying the spool in the background, unless a drain is already running."""
+        with self.lock:
+            # samples taken from now on go to a new segment
+            self.__close_segment()
+            self.last_sampled = {}
+            if self.thread is not None and self.thread.is_alive():
+                return
+            if not self.segments():
+                return
+            logging.info("Draining {} spool segment(s) at {} msg/s".format(len(self.segments()), self.rate))
+            self.thread = threading.Thread(target=self.__run_drain, args=(publish, is_connected),
+                                           name="s2m-spool-drain", daemon=True)
+            self.thread.start()
@@ -0,0 +1,50 @@
+import threading, logging
+
+
+class StateDocument(object):
+    """All of a host's metrics in one JSON document.
+
+    Collectors store their values under the topic they would otherwise
+    publish to, relative to the base topic (``cpu/usage``,
+    ``disks/storage/sysroot``, ...). The document keeps the latest value
+    of every metric, so collectors on slower periods still appear in it,
+    and is published as one message once the collectors of a tick are
+    done. Keys are flat because a topic can also have subtopics
+    (``disks/temperature/sda`` and ``disks/temperature/sda/stale``).
+    """
+
+    def __init__(self, base_topic):
+        self.prefix = base_topic.rstrip("/") + "/"
+        self.topic = self.prefix + "state"
+        self.values = {}
+        self.dirty = False
+        self.lock = threading.Lock()
+
+    def key(self, topic):
+        return topic[len(self.prefix):] if topic.startswith(self.prefix) else topic
+
+    def value_template(self, topic):
+        return "{{{{ value_json['{}'] }}}}".format(self.key(topic))
+
+    def set(self, topic, value):
+        key = self.key(topic)
+        with self.lock:
+            if key in self.values and self.values[key] == value:
+                return
+            self.values[key] = value
+            self.dirty = True
+
+    def dump(self):
+        """Return a copy of the document if something changed since the last dump, else None."""
+        with self.lock:
+            if not self.dirty:
+                return None
+            self.dirty = False
+            values = dict(self.values)
+        logging.debug("State document: {} value(s)".format(len(values)))
+        return values
+
+    def reset(self):
+        """Send the whole document again on the next dump, e.g. after reconnecting."""
+        with self.lock:
+            self.dirty = bool(self.values)
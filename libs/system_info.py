@@ -4,14 +4,36 @@ import subprocess
 import socket
 import logging
 import os
+import bisect
 
 # cpu_pct = psutil.cpu_percent(interval=0.1, percpu=False)
 # load = psutil.getloadavg()
 # mem = psutil.virtual_memory()
-from libs.optizfs import OptiZFS
+from libs.collectors import load_backend
+from libs.procfs import ProcReader, LoadAvg, PinnedFile
 
 Platform = platform.system()
 
+_zfs_available = None
+
+_zfs = None
+
+def zfs_available():
+    """Return True if the ZFS kernel module is loaded. Checked once, so libs.optizfs
+    is never imported on hosts without ZFS."""
+    global _zfs_available
+    if _zfs_available is None:
+        _zfs_available = os.path.exists("/sys/module/zfs") or os.path.exists("/proc/spl/kstat/zfs")
+        logging.debug("ZFS available: {}".format(_zfs_available))
+    return _zfs_available
+
+def get_zfs(ttl=60):
+    """Return the shared OptiZFS instance, or None on hosts without ZFS."""
+    global _zfs
+    if _zfs is None and zfs_available():
+        _zfs = load_backend("libs.optizfs").OptiZFS(ttl=ttl)
+    return _zfs
+
 def set_proc(procpath):
     psutil.PROCFS_PATH = procpath
 
@@ -24,13 +46,13 @@ def get_disks(procpath=None):
     disks = psutil.disk_partitions(all=False)
     all_disks = []
     try:
-        z = OptiZFS()
-        pools = z.get_pools()
-        for k, v in pools.items():
-            logging.debug("zfs pool: {}".format(k))
-            p = z.get_mountpoint(v)
-            if p not in all_disks:
-                all_disks.append(p)
+        z = get_zfs()
+        if z:
+            for k, v in z.get_pools().items():
+                logging.debug("zfs pool: {}".format(k))
+                p = z.get_mountpoint(v)
+                if p and p.startswith("/") and p not in all_disks:
+                    all_disks.append(p)
     except Exception as e:
         logging.debug(e)
     if Platform == 'Darwin':
@@ -55,16 +77,15 @@ def get_disk_space(mount_path, return_type='percent', procpath=None):
         set_proc(procpath)
     space_dict = {}
     try:
-        z = OptiZFS()
-        pools = z.get_pools()
-        for k, v in pools.items():
-            if mount_path == z.get_mountpoint(v):
-                storage = z.get_storage_percent(v)
-                logging.debug("mp: {} - {}%".format(mount_path, storage))
-                space_dict["percent"] = storage
-                output = space_dict.get(return_type)
-                logging.debug(output)
-                return output
+        z = get_zfs()
+        pool = z.get_pool_for_mountpoint(mount_path) if z else None
+        if pool is not None:
+            storage = z.get_storage_percent(pool)
+            logging.debug("mp: {} - {}%".format(mount_path, storage))
+            space_dict["percent"] = storage
+            output = space_dict.get(return_type)
+            logging.debug(output)
+            return output
     except Exception as e:
         logging.debug(e)
     space = psutil.disk_usage(mount_path)
@@ -77,8 +98,18 @@ def get_disk_space(mount_path, return_type='percent', procpath=None):
     return output
 
 
+_proc_readers = {}
+
+def get_proc_reader(procpath=None):
+    procpath = procpath or "/proc"
+    if procpath not in _proc_readers:
+        _proc_readers[procpath] = ProcReader(procpath)
+    return _proc_readers[procpath]
+
 def get_memory(return_type='percent', procpath=None):
     if Platform == "Linux":
+        if return_type in ("total", "used", "free", "percent", "available"):
+            return getattr(get_proc_reader(procpath).meminfo(), return_type)
         set_proc(procpath)
     mem_dict = {}
     mem = psutil.virtual_memory()
@@ -134,16 +165,163 @@ def get_temps(procpath=None):
             temps = None
     return temps
 
-def get_cpu(procpath=None):
+def get_load(procpath=None):
     if Platform == "Linux":
-        set_proc(procpath)
-    cpu = psutil.cpu_percent(interval=1)
-    return cpu
+        return get_proc_reader(procpath).loadavg()
+    return LoadAvg(*psutil.getloadavg())
+
+
+class CpuSample(object):
+    __slots__ = ("percent", "user", "system", "iowait", "steal", "cores")
+
+    def __init__(self, percent=0.0, user=0.0, system=0.0, iowait=0.0, steal=0.0, cores=()):
+        self.percent = percent
+        self.user = user
+        self.system = system
+        self.iowait = iowait
+        self.steal = steal
+        self.cores = cores
+
+
+class CpuSampler(object):
+    """Non-blocking CPU utilisation sampler.
+
+    Keeps the previous /proc/stat counters and reports utilisation since
+    the last call, so a reading is a single file read rather than a one
+    second sleep. The overall figure, per-core figures and the
+    user/system/iowait/steal breakdown all come from the same read.
+    On non-Linux platforms psutil's own non-blocking mode is used.
+    """
+
+    # /proc/stat column order after the "cpuN" label
+    FIELDS = ("user", "nice", "system", "idle", "iowait", "irq", "softirq", "steal")
+
+    def __init__(self, procpath=None):
+        self.procpath = procpath or "/proc"
+        self.previous = None
+        self.sample()
+
+    def __percentages(self, current, previous):
+        deltas = [max(0, c - p) for c, p in zip(current, previous)]
+        total = sum(deltas)
+        if not total:
+            return None
+        fields = dict(zip(self.FIELDS, deltas))
+        idle = fields["idle"] + fields["iowait"]
+        return {"percent": round((total - idle) * 100.0 / total, 1),
+                "user": round((fields["user"] + fields["nice"]) * 100.0 / total, 1),
+                "system": round((fields["system"] + fields["irq"] + fields["softirq"]) * 100.0 / total, 1),
+                "iowait": round(fields["iowait"] * 100.0 / total, 1),
+                "steal": round(fields["steal"] * 100.0 / total, 1)}
+
+    def __sample_linux(self):
+        current = get_proc_reader(self.procpath).stat_cpu()
+        previous = self.previous or {}
+        self.previous = current
+        overall = {}
+        cores = []
+        for name, counters in current.items():
+            if name not in previous:
+                continue
+            pcts = self.__percentages(counters, previous[name])
+            if pcts is None:
+                continue
+            if name == "cpu":
+                overall = pcts
+            else:
+                cores.append(pcts["percent"])
+        return CpuSample(cores=tuple(cores), **overall)
+
+    def __sample_psutil(self):
+        times = psutil.cpu_times_percent(interval=None)
+        return CpuSample(percent=psutil.cpu_percent(interval=None),
+                         user=round(times.user + getattr(times, "nice", 0.0), 1),
+                         system=round(times.system, 1),
+                         iowait=round(getattr(times, "iowait", 0.0), 1),
+                         steal=round(getattr(times, "steal", 0.0), 1),
+                         cores=tuple(psutil.cpu_percent(interval=None, percpu=True)))
+
+    def sample(self):
+        if Platform == "Linux":
+            return self.__sample_linux()
+        return self.__sample_psutil()
+
+
+_cpu_samplers = {}
+
+def get_cpu_sampler(procpath=None):
+    procpath = procpath or "/proc"
+    if procpath not in _cpu_samplers:
+        _cpu_samplers[procpath] = CpuSampler(procpath)
+    return _cpu_samplers[procpath]
+
+def get_cpu(procpath=None):
+    return get_cpu_sampler(procpath).sample().percent
 
 
 # Argon ONE I2C configuration
 
+class FanCurve(object):
+    """Argon fan curve from /etc/argoneon.conf or /etc/argononed.conf.
+
+    The ``temperature=speed`` lines are compiled once into two sorted lists
+    and looked up with bisect. The file is parsed again only when its
+    mtime or inode changes (argon-config rewrites it in place or replaces
+    it); otherwise a lookup costs one stat.
+    """
+
+    CONFIGS = ("/etc/argoneon.conf", "/etc/argononed.conf")
+
+    def __init__(self, configs=CONFIGS):
+        self.configs = configs
+        self.key = None
+        self.temps = []
+        self.speeds = []
+
+    def __stat(self):
+        for config_path in self.configs:
+            try:
+                st = os.stat(config_path)
+            except OSError:
+                continue
+            return config_path, st.st_ino, st.st_mtime_ns
+        return None
+
+    def __parse(self, config_path):
+        thresholds = {}
+        with open(config_path, "r") as f:
+            for line in f:
+                # Remove whitespace and skip empty lines or comments
+                line = line.strip()
+                if not line or line.startswith("#") or "=" not in line:
+                    continue
+                try:
+                    t_str, s_str = line.split("=")
+                    thresholds[float(t_str)] = int(float(s_str))
+                except ValueError:
+                    continue
+        self.temps = sorted(thresholds)
+        self.speeds = [thresholds[t] for t in self.temps]
+        logging.debug("Argon fan curve from {}: {}".format(config_path, thresholds))
+
+    def speed(self, temp):
+        key = self.__stat()
+        if key != self.key:
+            self.temps, self.speeds = [], []
+            if key is not None:
+                self.__parse(key[0])
+            self.key = key
+        # speed of the highest threshold at or below temp
+        i = bisect.bisect_right(self.temps, temp)
+        return self.speeds[i - 1] if i else 0
+
+
+_fan_curve = None
+
+_thermal_zone = None
+
 def get_argon_fan_speed():
+    global _fan_curve, _thermal_zone
     # 1. Read current CPU temperature
     fanspeedfile = "/tmp/fanspeed.txt"
     if os.path.exists(fanspeedfile):
@@ -151,43 +329,19 @@ def get_argon_fan_speed():
             speed = int(f.read().strip())
     else:
         try:
-            with open("/sys/class/thermal/thermal_zone0/temp", "r") as f:
-                # sysfs returns temp in millidegrees (e.g., 52345 = 52.345)
-                temp = float(f.read()) / 1000
-        except:
+            if _thermal_zone is None:
+                _thermal_zone = PinnedFile("/sys/class/thermal/thermal_zone0/temp", size=64)
+            # sysfs returns temp in millidegrees (e.g., 52345 = 52.345)
+            temp = float(_thermal_zone.read()) / 1000
+        except (OSError, ValueError):
             return 0
 
-        # 2. Parse the config file
-        poss_configs = ["/etc/argoneon.conf", "/etc/argononed.conf"]
-        thresholds = {}  # Initialize outside the loop
-
-        for config_path in poss_configs:
-            if os.path.exists(config_path):
-                with open(config_path, "r") as f:
-                    for line in f:
-                        # Remove whitespace and skip empty lines or comments
-                        line = line.strip()
-                        if not line or line.startswith("#"):
-                            continue
-                        
-                        if "=" in line:
-                            try:
-                                t_str, s_str = line.split("=")
-                                # Convert both sides to numbers
-                                thresholds[float(t_str)] = int(float(s_str))
-                            except ValueError:
-                                continue
-                break # Found a file, processed it, now stop searching
-
-        # 3. Determine speed (Sort highest temp to lowest)
-        speed = 0
-        # sorting ensures we check 65, then 60, then 55, then 50...
-        for t in sorted(thresholds.keys(), reverse=True):
-            if temp >= t:
-                speed = thresholds[t]
-                break
-
-    # 4. Argon Safety Floor: 1-24% is always rounded to 25%
+        # 2. Determine speed from the (cached) fan curve
+        if _fan_curve is None:
+            _fan_curve = FanCurve()
+        speed = _fan_curve.speed(temp)
+
+    # 3. Argon Safety Floor: 1-24% is always rounded to 25%
     if 0 < speed < 25:
         return 25
 
@@ -2,16 +2,25 @@
 
 # send all system info to mqtt
 
-import logging, time, os, sys, ast
+import logging, time, os, sys, ast, asyncio
 from decimal import Decimal
 from subprocess import check_call
 
-from libs.system_info import get_temps, Platform, get_hostname, get_disks, get_disk_space, get_memory, get_cpu, set_proc, get_argon_fan_speed
+from libs.system_info import get_temps, Platform, get_hostname, get_disks, get_disk_space, get_memory, get_cpu_sampler, get_load, get_zfs, set_proc, get_argon_fan_speed
 from libs.myqtt import Myqtt
-from libs.optimox import OptiMOX, prox_auth
 from libs.parser import Parser
-from libs.argon import gethddtemp
-from libs.homeassistant import ha_config
+from libs.discovery import DiscoveryRegistry, RateLimiter
+from libs.scheduler import Scheduler
+from libs.collectors import collector, enabled_collectors, load_backend
+from libs.snapshot import Snapshot
+from libs.mountwatch import MountWatcher, mountinfo_available
+from libs.sensors import get_sensor_index
+from libs.availability import Availability
+from libs.publishfilter import PublishFilter
+from libs.statedoc import StateDocument
+from libs.spool import Spool
+from libs.policy import PolicyTable
+from libs.codec import Codec
 
 hostname = get_hostname()
 
@@ -48,86 +57,185 @@ def setupLogging(DEBUG_MODE=False, conf=None):
 
 ################################################################################################
 
-class System2Mqtt(object):
-
-    def __init__(self, conf):
-
-        print("Getting config from:\n", conf)
-
-        self.config = Parser(conf)
-        setupLogging(self.config.DEBUG_LOG, self.config)
-        logging.debug("logging has been set up")
-        self.lwt_topic = self.config.MQTT_BASE_TOPIC + "/LWT"
-        self.availability_topic = self.lwt_topic
-
-        self.myqtt = Myqtt(host=self.config.MQTT_HOST,
-                            port=self.config.MQTT_PORT,
-                            username=self.config.MQTT_USER,
-                            password=self.config.MQTT_PASSWORD)
-
-        self.myqtt.lwt_topic = self.lwt_topic
-        self.myqtt.topic_callbacks = self.__get_subscription_calbacks()
-
-        if self.config.PVE_SYSTEM:
-            self.pve = OptiMOX(prox_auth(self.config.PVE_HOST,
-                                        self.config.PVE_USER,
-                                        self.config.PVE_PASSWORD))
-
-        self.auto_reconnect = True
-
-        self.mounted_disks = []
-
+class Publisher(object):
+    """Everything published under one base topic and Home Assistant device.
+
+    Holds the base topic's discovery registry, publish filter, state
+    document and spool, and the collectors writing to them. The agent is
+    one; with PVE_NODES every node is a PveTarget sharing the agent's MQTT
+    connection, codec and Proxmox session. Subclasses provide
+    ``publish_period``.
+    """
+
+    def __init__(self, config, myqtt, codec, lwt_topic, discovery_limiter, pve=None):
+        self.config = config
+        self.myqtt = myqtt
+        self.codec = codec
+        self.lwt_topic = lwt_topic
+        self.availability_topic = lwt_topic
+        self.discovery_limiter = discovery_limiter
+        self.pve = pve
         self.ha_discovery_template = "{}/{}/{}/config".format(self.config.HA_DISCOVERY_BASE, "{}", "{}")
-
-        self.publish_period = self.config.PUBLISH_PERIOD
-
-        self.first_loop_done = False
-
-    def __get_subscription_calbacks(self):
-        logging.debug("")
-        sub_dict = {self.config.MQTT_BASE_TOPIC + "/tele/PUBLISH_PERIOD": self.s2m_set_publish_period,
-                    self.config.MQTT_BASE_TOPIC + "/callbacks/s2m_quit": self.quit_s2m,
-                    self.config.MQTT_BASE_TOPIC + "/callbacks/shutdown": self.cb_shutdown,
-                    self.config.MQTT_BASE_TOPIC + "/callbacks/reboot": self.cb_reboot}
-        return sub_dict
-
-    def run(self):
-        self.config.print_config()
-        try:
-            self.process_user_callbacks()
-        except Exception as e:
-            logging.error(e, exc_info=True)
-        self.myqtt.run()
-        self.wait()
-
-    def wait(self):
-        logging.debug("...")
-        while True:
-            while not self.myqtt.client.is_connected():
-                logging.debug("Trying to connect...")
-                time.sleep(2)
-            self.start_publish_loop()
-            if not self.auto_reconnect:
-                break
-            logging.info("Reconnecting...")
-        logging.warning("Main Loop Ended!")
-
-    def start_publish_loop(self):
-        logging.info("Publish period is set to {} seconds.".format(self.publish_period))
-        while self.myqtt.client.is_connected():
-            logging.debug("mqtt flag: {}".format(self.myqtt.connected_flag))
-            self.publish_all()
-            time.sleep(int(self.publish_period))
-
-    def publish_mount_state(self):
+        self.ha_device = self.config.COMPUTER_NAME.replace(" ", "_").replace("-", "_")
+        self.discovery = None
+        if self.config.HA_DISCOVERY:
+            device_topic = None
+            if self.config.HA_DISCOVERY_DEVICE:
+                device_topic = self.config.HA_DISCOVERY_BASE + "/device/{}/config"
+            self.discovery = DiscoveryRegistry(self.myqtt, limiter=self.discovery_limiter,
+                                               base_topic=self.config.MQTT_BASE_TOPIC,
+                                               compact=self.config.HA_DISCOVERY_COMPACT,
+                                               device_topic=device_topic)
+        self.publish_filter = None
+        if self.config.PUBLISH_CHANGES_ONLY:
+            self.publish_filter = PublishFilter(self.config.MQTT_BASE_TOPIC,
+                                                deadbands=self.config.DEADBANDS,
+                                                max_silence=self.config.MAX_SILENCE)
+        self.state_document = None
+        if self.config.STATE_JSON:
+            self.state_document = StateDocument(self.config.MQTT_BASE_TOPIC)
+        self.spool = None
+        if self.config.SPOOL:
+            spool_dir = self.config.SPOOL_DIR
+            if spool_dir.startswith("./"):
+                spool_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), spool_dir[2:])
+            self.spool = Spool(spool_dir,
+                               max_bytes=self.config.SPOOL_MAX_MB * 1024 * 1024,
+                               retention=self.config.SPOOL_RETENTION,
+                               downsample=self.config.SPOOL_DOWNSAMPLE,
+                               rate=self.config.SPOOL_DRAIN_RATE)
+
+    def schedule(self, scheduler, spec, name=None):
+        period = getattr(self.config, spec.period_key) if spec.period_key else None
+        func = getattr(self, spec.method)
+        if self.discovery:
+            func = self.discovery.track(spec.name, func)
+        return scheduler.add(name or spec.name, func, period)
+
+    def new_snapshot(self):
+        """Sources shared by the collectors of one tick, each fetched at most once."""
+        procpath = self.config.PROCPATH
+        sources = {"disks": lambda: tuple(get_disks(procpath=procpath)),
+                   "temps": lambda: get_temps(procpath=procpath)}
+        if not self.config.MACOS:
+            sensors = get_sensor_index(rescan_period=self.config.SENSOR_RESCAN_PERIOD)
+            sources["cpu_temp"] = sensors.cpu_temperature
+            sources["fans"] = sensors.fans
+        if self.config.PVE_SYSTEM:
+            node = self.config.PVE_NODE_NAME
+            sources["pve_storage"] = lambda: self.pve.getNodeStorage(node)["data"]
+            sources["pve_status"] = lambda: self.pve.getNodeStatus(node)["data"]
+        return Snapshot(sources)
+
+    def reconnected(self):
+        """Bring the broker up to date after (re)connecting."""
+        if self.publish_filter:
+            self.publish_filter.reset()
+        if self.state_document:
+            self.state_document.reset()
+        if self.discovery:
+            # the broker may have lost retained configs, e.g. when it restarted
+            self.discovery.republish()
+        if self.spool:
+            self.spool.drain(self.publish_backlog, self.myqtt.client.is_connected)
+        # tells consumers how payloads are encoded, MQTT v5 also marks every message
+        self.myqtt.publish(self.config.MQTT_BASE_TOPIC + "/s2m/content_type", self.codec.content_type, retain=True)
+
+    def discover(self, ha_type, key, name, topic, metric=True, **kwargs):
+        """Register a Home Assistant entity for ``topic``, identified by ``key`` within this host.
+
+        Metric topics go through state_topic()/value_template(), so the
+        entity follows STATE_JSON.
+        """
+        if not self.discovery:
+            return
+        object_id = "s2m_{}_{}".format(self.ha_device, key)
+        if metric:
+            kwargs["state_topic"] = self.state_topic(topic)
+            kwargs["value_template"] = self.value_template(topic)
+        else:
+            kwargs["state_topic"] = topic
+        kwargs.setdefault("availability_topic", self.availability_topic)
+        self.discovery.add(self.ha_discovery_template.format(ha_type, object_id), name=name, object_id=object_id,
+                           device=self.ha_device, entity_type=ha_type, **kwargs)
+
+    def publish_metric(self, topic, payload, retain=False):
+        """Publish a collector value, unless PUBLISH_CHANGES_ONLY is set and it did not change.
+
+        With STATE_JSON the value goes into the state document instead.
+        """
+        if self.state_document:
+            self.state_document.set(topic, payload)
+            return
+        if self.publish_filter and not self.publish_filter.should_publish(topic, payload):
+            return
+        self.send(topic, payload, retain=retain)
+
+    def send(self, topic, payload, retain=False):
+        """Publish telemetry, or keep it in the spool while the broker is unreachable."""
+        if self.spool and not self.myqtt.client.is_connected():
+            self.spool.append(topic, payload, retain=retain)
+            return
+        payload, content_type = self.codec.encode(payload)
+        self.myqtt.publish(topic, payload, retain=retain, expiry=self.message_expiry(), content_type=content_type)
+
+    def message_expiry(self):
+        """MQTT v5 message expiry for telemetry: MQTT_MESSAGE_EXPIRY, or two publish periods."""
+        if self.config.MQTT_MESSAGE_EXPIRY is not None:
+            return self.config.MQTT_MESSAGE_EXPIRY
+        return 2 * int(self.publish_period)
+
+    def publish_backlog(self, topic, payload, timestamp, retain=False):
+        """Replay a spooled message on <base>/backlog/... with the time it was sampled."""
+        base = self.config.MQTT_BASE_TOPIC + "/"
+        if topic.startswith(base):
+            topic = topic[len(base):]
+        payload, content_type = self.codec.encode({"ts": timestamp, "value": payload})
+        self.myqtt.publish(base + "backlog/" + topic, payload, qos=1, content_type=content_type)
+
+    def collectors_done(self):
+        """Called once the collectors of a tick have all returned."""
+        self.publish_state_document()
+        if self.discovery:
+            self.discovery.flush()
+
+    def publish_state_document(self):
+        if self.state_document is None:
+            return
+        payload = self.state_document.dump()
+        if payload is not None:
+            self.send(self.state_document.topic, payload)
+
+    def state_topic(self, topic):
+        """The topic HA discovery should read a metric from."""
+        if self.state_document:
+            return self.state_document.topic
+        return topic
+
+    def value_template(self, topic):
+        if self.state_document:
+            return self.state_document.value_template(topic)
+        return None
+
+    def storage_allowed(self, label, path=None):
+        return self.config.STORAGE_FILTER.allowed(label, path)
+
+    def mount_label(self, mountpoint):
+        return "sysroot" if mountpoint == "/" else mountpoint.split("/")[-1]
+
+    @collector("mount_state", period_key="MOUNT_STATE_PERIOD", per_node=True,
+               enabled=lambda config: config.PVE_SYSTEM or not mountinfo_available(config.PROCPATH))
+    def publish_mount_state(self, snapshot):
         logging.debug("")
         ha_type = "binary_sensor"
         ha_class = "connectivity"
         slug = "/disks/mount/"
         base = self.config.MQTT_BASE_TOPIC + slug
+        # the sensor turns off when a run is missed, so allow for this job's own interval
+        off_delay = int(self.config.MOUNT_STATE_PERIOD or self.publish_period) + 10
         try:
             if not self.config.PVE_SYSTEM:
-                disks = get_disks(procpath=self.config.PROCPATH)
+                disks = snapshot.get("disks")
                 for d in disks:
                     if d == "/":
                         label = "sysroot"
@@ -135,93 +243,34 @@ class System2Mqtt(object):
                         label = d.split("/")[-1]
                     final_topic = base + label
                     logging.debug("\nlabel: {}\n".format(label))
-                    if self.config.STORAGE_INCLUDE:
-                        include = ast.literal_eval(self.config.STORAGE_INCLUDE.lower())
-                        if label.lower() in include:
-                            logging.debug("...included")
-                            pass
-                        else:
-                            logging.debug("...ignoring")
-                            continue
-                    else:
-                        if self.config.STORAGE_EXCLUDE:
-                            exclude = ast.literal_eval(self.config.STORAGE_EXCLUDE.lower())
-                            if not label.lower() in exclude:
-                                pass
-                            else:
-                                continue
+                    if not self.storage_allowed(label, d):
+                        continue
                     logging.info("{} is mounted - publishing to '{}'".format(label, final_topic))
+                    # always sent: the discovery config turns the sensor off after off_delay without it
                     self.myqtt.publish(final_topic, "mounted")
-                    if self.config.HA_DISCOVERY and not self.first_loop_done:
-                        title = label
-                        for char in (" ", "-"):
-                            label = label.lower().replace(char, "_")
-                        device = self.config.COMPUTER_NAME
-                        logging.debug("device: {}".format(device))
-                        for char in (" ", "-"):
-                            device = device.replace(char, "_")
-                        ha_object_id = "s2m_"+device+"_{}_{}".format(label, "mounted")
-                        logging.debug("object_id: {}".format(ha_object_id))
-                        ha_name = "{} Mount State".format(title).title()
-                        logging.debug("ha_name: {}".format(ha_name))
-                        logging.debug("ha_type: {}".format(ha_type))
-                        dtt = self.ha_discovery_template.format(ha_type, ha_object_id)
-                        logging.debug("dtt: {}".format(dtt))
-                        haconfig = ha_config(discovery_topic=dtt, name=ha_name, object_id=ha_object_id,
-                                             state_topic=final_topic, device=device, payload_on="mounted",
-                                             off_delay=int(self.publish_period)+10, entity_type=ha_type, device_class=ha_class, 
-                                             availability_topic=self.availability_topic, 
-                                             payload_available="online",
-                                             payload_not_available="offline")
-                        self.myqtt.publish(haconfig[0], haconfig[1], retain=True)
-                        logging.debug("T: {}".format(haconfig[0]))
-                        logging.debug("P: {}".format(haconfig[1]))
-                    else:
-                        logging.debug("HA Discovery not being sent")
+                    self.discover(ha_type, "{}_mounted".format(label.lower().replace(" ", "_").replace("-", "_")),
+                                  "{} Mount State".format(label).title(), final_topic, metric=False,
+                                  payload_on="mounted", off_delay=off_delay, device_class=ha_class)
             elif self.config.PVE_SYSTEM:
-                storage_data = self.pve.getNodeStorage(self.config.PVE_NODE_NAME)["data"]
+                storage_data = snapshot.get("pve_storage")
                 for storage in storage_data:
                     label = storage["storage"]
                     state = storage["active"]
                     final_topic = base + label
-                    if self.config.STORAGE_INCLUDE:
-                        include = ast.literal_eval(self.config.STORAGE_INCLUDE.lower())
-                        if label.lower() in include:
-                            pass
-                        else:
-                            continue
-                    else:
-                        if self.config.STORAGE_EXCLUDE:
-                            exclude = ast.literal_eval(self.config.STORAGE_EXCLUDE.lower())
-                            if not label.lower() in exclude:
-                                pass
-                            else:
-                                continue
+                    if not self.storage_allowed(label):
+                        continue
                     logging.info("Storage: {}: {}%".format(label, state))
-                    self.myqtt.publish(final_topic, state)
-                    if self.config.HA_DISCOVERY and not self.first_loop_done:
-                        title = label
-                        for char in (" ", "-"):
-                            label = label.lower().replace(char, "_")
-                        device = self.config.COMPUTER_NAME
-                        for char in (" ", "-"):
-                            device = device.replace(char, "_")
-                        ha_object_id = "s2m_"+device+"_{}_{}".format(label, "mounted")
-                        ha_name = "{} Mount State".format(title).title()
-                        dtt = self.ha_discovery_template.format(ha_type, ha_object_id)
-                        haconfig = ha_config(discovery_topic=dtt, name=ha_name, object_id=ha_object_id,
-                                             entity_type = ha_type, device_class = ha_class,
-                                             state_topic=final_topic, device=device, payload_on=1, payload_off=0, 
-                                             availability_topic=self.availability_topic, 
-                                             payload_available="online",
-                                             payload_not_available="offline")
-                        self.myqtt.publish(haconfig[0], haconfig[1], retain=True)
+                    self.publish_metric(final_topic, state)
+                    self.discover(ha_type, "{}_mounted".format(label.lower().replace(" ", "_").replace("-", "_")),
+                                  "{} Mount State".format(label).title(), final_topic,
+                                  payload_on=1, payload_off=0, device_class=ha_class)
             else:
                 logging.warning("Hmm, something went wrong")
         except Exception as e:
             logging.error(e, exc_info=True)
 
-    def publish_disk_space(self):
+    @collector("disk_space", period_key="DISK_SPACE_PERIOD", per_node=True)
+    def publish_disk_space(self, snapshot):
         logging.debug("")
         ha_type = "sensor"
         ha_icon = "mdi:harddisk"
@@ -230,91 +279,40 @@ class System2Mqtt(object):
         base = self.config.MQTT_BASE_TOPIC + slug
         try:
             if not self.config.PVE_SYSTEM:
-                disks = get_disks(procpath=self.config.PROCPATH)
+                disks = snapshot.get("disks")
                 for d in disks:
                     # space = get_disk_space(d, procpath=self.config.PROCPATH)
                     if d == "/":
                         label = "sysroot"
                     else:
                         label = d.split("/")[-1]
-                    if self.config.STORAGE_INCLUDE:
-                        include = ast.literal_eval(self.config.STORAGE_INCLUDE.lower())
-                        logging.debug(include)
-                        logging.debug(type(include))
-                        if label.lower() in include:
-                            pass
-                        else:
-                            continue
-                    else:
-                        if self.config.STORAGE_EXCLUDE:
-                            exclude = ast.literal_eval(self.config.STORAGE_EXCLUDE.lower())
-                            if not label.lower() in exclude:
-                                pass
-                            else:
-                                continue
+                    if not self.storage_allowed(label, d):
+                        continue
                     space = get_disk_space(d, procpath=self.config.PROCPATH)
                     final_topic = base + label
-                    self.myqtt.publish(final_topic, space)
-                    if self.config.HA_DISCOVERY and not self.first_loop_done:
-                        title = label
-                        for char in (" ", "-"):
-                            label = label.lower().replace(char, "_")
-                        device = self.config.COMPUTER_NAME
-                        for char in (" ", "-"):
-                            device = device.replace(char, "_")
-                        ha_object_id = "s2m_"+device+"_{}_{}".format(label, "storage")
-                        ha_name = "{} Storage".format(title).title()
-                        dtt = self.ha_discovery_template.format(ha_type, ha_object_id)
-                        haconfig = ha_config(discovery_topic=dtt, name=ha_name, object_id=ha_object_id, state_topic=final_topic,
-                                             device=device, icon=ha_icon, entity_type=ha_type, unit=ha_unit, 
-                                             availability_topic=self.availability_topic, 
-                                             payload_available="online",
-                                             payload_not_available="offline")
-                        self.myqtt.publish(haconfig[0], haconfig[1], retain=True)
+                    self.publish_metric(final_topic, space)
+                    self.discover(ha_type, "{}_storage".format(label.lower().replace(" ", "_").replace("-", "_")),
+                                  "{} Storage".format(label).title(), final_topic, icon=ha_icon, unit=ha_unit)
             elif self.config.PVE_SYSTEM:
-                storage_data = self.pve.getNodeStorage(self.config.PVE_NODE_NAME)["data"]
+                storage_data = snapshot.get("pve_storage")
                 logging.debug(storage_data)
                 for storage in storage_data:
                     label = storage["storage"]
                     pct = int(float(storage["used_fraction"]) * 100)
                     final_topic = base + label
-                    if self.config.STORAGE_INCLUDE:
-                        include = ast.literal_eval(self.config.STORAGE_INCLUDE.lower())
-                        if label.lower() in include:
-                            pass
-                        else:
-                            continue
-                    else:
-                        if self.config.STORAGE_EXCLUDE:
-                            exclude = ast.literal_eval(self.config.STORAGE_EXCLUDE.lower())
-                            if not label.lower() in exclude:
-                                pass
-                            else:
-                                continue
+                    if not self.storage_allowed(label):
+                        continue
                     logging.info("Storage: {}: {}%".format(label, pct))
-                    self.myqtt.publish(final_topic, pct)
-                    if self.config.HA_DISCOVERY and not self.first_loop_done:
-                        title = label
-                        for char in (" ", "-"):
-                            label = label.lower().replace(char, "_")
-                        device = self.config.COMPUTER_NAME
-                        for char in (" ", "-"):
-                            device = device.replace(char, "_")
-                        ha_object_id = "s2m_"+device+"_{}_{}".format(label, "storage")
-                        ha_name = "{} Storage".format(title).title()
-                        dtt = self.ha_discovery_template.format(ha_type, ha_object_id)
-                        haconfig = ha_config(discovery_topic=dtt, name=ha_name, object_id=ha_object_id, state_topic=final_topic,
-                                             device=device, icon=ha_icon, entity_type=ha_type, unit=ha_unit, 
-                                             availability_topic=self.availability_topic, 
-                                             payload_available="online",
-                                             payload_not_available="offline")
-                        self.myqtt.publish(haconfig[0], haconfig[1], retain=True)
+                    self.publish_metric(final_topic, pct)
+                    self.discover(ha_type, "{}_storage".format(label.lower().replace(" ", "_").replace("-", "_")),
+                                  "{} Storage".format(label).title(), final_topic, icon=ha_icon, unit=ha_unit)
             else:
                 logging.warning("Hmm, something went wrong")
         except Exception as e:
             logging.error(e, exc_info=True)
 
-    def publish_cpu_temp(self):
+    @collector("cpu_temp", period_key="CPU_TEMP_PERIOD")
+    def publish_cpu_temp(self, snapshot):
         logging.debug("")
         ha_type = "sensor"
         ha_class = "temperature"
@@ -324,57 +322,47 @@ class System2Mqtt(object):
         final_topic = self.config.MQTT_BASE_TOPIC + slug
         try:
             if self.config.MACOS:
+                temp = snapshot.get("temps")
                 try:
-                    dec = Decimal(get_temps(procpath=self.config.PROCPATH))
-                    temp = str(round(dec, 1))
+                    temp = float(round(Decimal(temp), 1))
                 except Exception as e:
                     logging.warning(e)
-                    temp = get_temps(procpath=self.config.PROCPATH)
                 logging.info("CPU temperature: {}°C".format(temp))
-                self.myqtt.publish(final_topic, temp)
-                if self.config.HA_DISCOVERY and not self.first_loop_done:
-                    title = self.config.COMPUTER_NAME + " CPU Temperature"
-                    device = self.config.COMPUTER_NAME
-                    for char in (" ", "-"):
-                        device = device.replace(char, "_")
-                    ha_object_id = "s2m_" + device + "_{}".format("cpu_temperature")
-                    ha_name = title.title()
-                    dtt = self.ha_discovery_template.format(ha_type, ha_object_id)
-                    haconfig = ha_config(discovery_topic=dtt, name=ha_name, object_id=ha_object_id, state_topic=final_topic,
-                                         device=device, entity_type=ha_type, unit=ha_unit, device_class=ha_class, 
-                                         availability_topic=self.availability_topic, 
-                                         payload_available="online",
-                                         payload_not_available="offline")
-                    self.myqtt.publish(haconfig[0], haconfig[1], retain=True)
+                self.publish_metric(final_topic, temp)
+                self.discover(ha_type, "cpu_temperature", (self.config.COMPUTER_NAME + " CPU Temperature").title(),
+                              final_topic, unit=ha_unit, device_class=ha_class)
             else:
-                try:
-                    temps = get_temps(procpath=self.config.PROCPATH)["coretemp"]
-                except:
-                    temps = get_temps(procpath=self.config.PROCPATH)["cpu_thermal"]
-                c_list = []
-                for temp in temps:
-                    c_list.append(temp.current)
-                highest = max(c_list)
+                highest = snapshot.get("cpu_temp")
+                if highest is None:
+                    logging.warning("No CPU temperature sensor found")
+                    return
                 logging.info("CPU temperature: {}°C".format(highest))
-                self.myqtt.publish(final_topic, str(highest))
-                if self.config.HA_DISCOVERY and not self.first_loop_done:
-                    title = self.config.COMPUTER_NAME + " CPU Temperature"
-                    device = self.config.COMPUTER_NAME
-                    for char in (" ", "-"):
-                        device = device.replace(char, "_")
-                    ha_object_id = "s2m_" + device + "_{}".format("cpu_temperature")
-                    ha_name = title.title()
-                    dtt = self.ha_discovery_template.format(ha_type, ha_object_id)
-                    haconfig = ha_config(discovery_topic=dtt, name=ha_name, object_id=ha_object_id, state_topic=final_topic,
-                                         device=device, entity_type=ha_type, unit=ha_unit, device_class=ha_class, 
-                                         availability_topic=self.availability_topic, 
-                                         payload_available="online",
-                                         payload_not_available="offline")
-                    self.myqtt.publish(haconfig[0], haconfig[1], retain=True)
+                self.publish_metric(final_topic, highest)
+                self.discover(ha_type, "cpu_temperature", (self.config.COMPUTER_NAME + " CPU Temperature").title(),
+                              final_topic, unit=ha_unit, device_class=ha_class)
         except Exception as e:
             logging.error(e, exc_info=True)
 
-    def publish_cpu_usage(self):
+    @collector("fans", period_key="FANS_PERIOD", enabled=lambda config: not config.MACOS and not config.PVE_SYSTEM)
+    def publish_fans(self, snapshot):
+        logging.debug("")
+        ha_type = "sensor"
+        ha_unit = "RPM"
+        ha_icon = "mdi:fan"
+        slug = "/fans/"
+        base = self.config.MQTT_BASE_TOPIC + slug
+        try:
+            for label, rpm in snapshot.get("fans").items():
+                final_topic = base + label
+                logging.info("Fan {}: {} RPM".format(label, rpm))
+                self.publish_metric(final_topic, rpm)
+                self.discover(ha_type, "{}_fan".format(label), "{} Fan".format(label.replace("_", " ")).title(),
+                              final_topic, icon=ha_icon, unit=ha_unit)
+        except Exception as e:
+            logging.error(e, exc_info=True)
+
+    @collector("cpu_usage", period_key="CPU_USAGE_PERIOD", per_node=True)
+    def publish_cpu_usage(self, snapshot):
         logging.debug("")
         ha_type = "sensor"
         ha_unit = "%"
@@ -383,49 +371,47 @@ class System2Mqtt(object):
         final_topic = self.config.MQTT_BASE_TOPIC + slug
         try:
             if not self.config.PVE_SYSTEM:
-                cpu = get_cpu(procpath=self.config.PROCPATH)
+                sample = get_cpu_sampler(procpath=self.config.PROCPATH).sample()
+                cpu = sample.percent
                 logging.info("CPU usage: {}%".format(cpu))
-                self.myqtt.publish(final_topic, cpu)
-                if self.config.HA_DISCOVERY and not self.first_loop_done:
-                    title = self.config.COMPUTER_NAME + " CPU Usage"
-                    device = self.config.COMPUTER_NAME
-                    for char in (" ", "-"):
-                        device = device.replace(char, "_")
-                    ha_object_id = "s2m_" + device + "_{}".format("cpu")
-                    ha_name = title.title()
-                    dtt = self.ha_discovery_template.format(ha_type, ha_object_id)
-                    haconfig = ha_config(discovery_topic=dtt, name=ha_name, object_id=ha_object_id, state_topic=final_topic,
-                                         device=device, icon=ha_icon, entity_type=ha_type, unit=ha_unit, 
-                                         availability_topic=self.availability_topic, 
-                                         payload_available="online",
-                                         payload_not_available="offline")
-                    self.myqtt.publish(haconfig[0], haconfig[1], retain=True)
+                self.publish_metric(final_topic, cpu)
+                if self.config.CPU_DETAIL:
+                    self.publish_cpu_detail(sample)
+                self.discover(ha_type, "cpu", (self.config.COMPUTER_NAME + " CPU Usage").title(), final_topic,
+                              icon=ha_icon, unit=ha_unit)
             elif self.config.PVE_SYSTEM:
-                cpu = self.pve.getNodeStatus(self.config.PVE_NODE_NAME)["data"]["cpu"]
+                cpu = snapshot.get("pve_status")["cpu"]
                 pct = int(float(cpu) * 100)
                 logging.info("CPU usage: {}%".format(pct))
                 if pct > 0:
-                    self.myqtt.publish(final_topic, pct)
-                    if self.config.HA_DISCOVERY and not self.first_loop_done:
-                        title = self.config.COMPUTER_NAME + " CPU Usage"
-                        device = self.config.COMPUTER_NAME
-                        for char in (" ", "-"):
-                            device = device.replace(char, "_")
-                        ha_object_id = "s2m_" + device + "_{}".format("cpu")
-                        ha_name = title.title()
-                        dtt = self.ha_discovery_template.format(ha_type, ha_object_id)
-                        haconfig = ha_config(discovery_topic=dtt, name=ha_name, object_id=ha_object_id, state_topic=final_topic,
-                                             device=device, icon=ha_icon, entity_type=ha_type, unit=ha_unit, 
-                                             availability_topic=self.availability_topic, 
-                                             payload_available="online",
-                                             payload_not_available="offline")
-                        self.myqtt.publish(haconfig[0], haconfig[1], retain=True)
+                    self.publish_metric(final_topic, pct)
+                    self.discover(ha_type, "cpu", (self.config.COMPUTER_NAME + " CPU Usage").title(), final_topic,
+                                  icon=ha_icon, unit=ha_unit)
             else:
                 logging.warning("Hmm, something went wrong")
         except Exception as e:
             logging.error(e, exc_info=True)
 
-    def publish_ram(self):
+    def publish_cpu_detail(self, sample):
+        logging.debug("")
+        ha_type = "sensor"
+        ha_icon = "mdi:cpu-64-bit"
+        base = self.config.MQTT_BASE_TOPIC + "/cpu/"
+        load = get_load(procpath=self.config.PROCPATH)
+        entities = [(field, field, "CPU {}".format(field), getattr(sample, field), "%")
+                    for field in ("user", "system", "iowait", "steal")]
+        entities += [("core/{}".format(i), "core_{}".format(i), "CPU Core {}".format(i), pct, "%")
+                     for i, pct in enumerate(sample.cores)]
+        entities += [("load/{}".format(n), "load_{}".format(n), "Load {}m".format(n), getattr(load, "load{}".format(n)), None)
+                     for n in (1, 5, 15)]
+        for slug, key, title, value, ha_unit in entities:
+            final_topic = base + slug
+            self.publish_metric(final_topic, value)
+            self.discover(ha_type, "cpu_{}".format(key), "{} {}".format(self.config.COMPUTER_NAME, title).title(),
+                          final_topic, icon=ha_icon, unit=ha_unit)
+
+    @collector("memory", period_key="MEMORY_PERIOD", per_node=True)
+    def publish_ram(self, snapshot):
         logging.debug("Getting ram")
         ha_type = "sensor"
         ha_unit = "%"
@@ -436,48 +422,25 @@ class System2Mqtt(object):
             if not self.config.PVE_SYSTEM:
                 mem = get_memory(procpath=self.config.PROCPATH)
                 logging.info("Memory Used: {}%".format(mem))
-                self.myqtt.publish(final_topic, mem)
-                if self.config.HA_DISCOVERY and not self.first_loop_done:
-                    title = self.config.COMPUTER_NAME + " Memory Usage"
-                    device = self.config.COMPUTER_NAME
-                    for char in (" ", "-"):
-                        device = device.replace(char, "_")
-                    ha_object_id = "s2m_" + device + "_{}".format("memory")
-                    ha_name = title.title()
-                    dtt = self.ha_discovery_template.format(ha_type, ha_object_id)
-                    haconfig = ha_config(discovery_topic=dtt, name=ha_name, object_id=ha_object_id, state_topic=final_topic,
-                                         device=device, icon=ha_icon, entity_type=ha_type, unit=ha_unit, 
-                                         availability_topic=self.availability_topic, 
-                                         payload_available="online",
-                                         payload_not_available="offline")
-                    self.myqtt.publish(haconfig[0], haconfig[1], retain=True)
+                self.publish_metric(final_topic, mem)
+                self.discover(ha_type, "memory", (self.config.COMPUTER_NAME + " Memory Usage").title(), final_topic,
+                              icon=ha_icon, unit=ha_unit)
             elif self.config.PVE_SYSTEM:
-                ram_dict = self.pve.getNodeStatus(self.config.PVE_NODE_NAME)["data"]["memory"]
+                ram_dict = snapshot.get("pve_status")["memory"]
                 used = float(ram_dict["used"])
                 total = float(ram_dict["total"])
                 pct = int((used / total) * 100)
                 logging.info("Ram usage: {}%".format(pct))
-                self.myqtt.publish(final_topic, pct)
-                if self.config.HA_DISCOVERY and not self.first_loop_done:
-                    title = self.config.COMPUTER_NAME + " Memory Usage"
-                    device = self.config.COMPUTER_NAME
-                    for char in (" ", "-"):
-                        device = device.replace(char, "_")
-                    ha_object_id = "s2m_" + device + "_{}".format("memory")
-                    ha_name = title.title()
-                    dtt = self.ha_discovery_template.format(ha_type, ha_object_id)
-                    haconfig = ha_config(discovery_topic=dtt, name=ha_name, object_id=ha_object_id, state_topic=final_topic,
-                                         device=device, icon=ha_icon, entity_type=ha_type, unit=ha_unit, 
-                                         availability_topic=self.availability_topic, 
-                                         payload_available="online",
-                                         payload_not_available="offline")
-                    self.myqtt.publish(haconfig[0], haconfig[1], retain=True)
+                self.publish_metric(final_topic, pct)
+                self.discover(ha_type, "memory", (self.config.COMPUTER_NAME + " Memory Usage").title(), final_topic,
+                              icon=ha_icon, unit=ha_unit)
             else:
                 logging.warning("Not MacOS or PVE system")
         except Exception as e:
             logging.error(e, exc_info=True)
     
-    def publish_argon(self):
+    @collector("fan_speed", period_key="FAN_SPEED_PERIOD", enabled=lambda config: config.ARGON)
+    def publish_argon(self, snapshot):
         if self.config.ARGON:
             logging.debug("Getting fan speed")
             slug = "/fan_speed"
@@ -488,24 +451,15 @@ class System2Mqtt(object):
             try:
                 speed = get_argon_fan_speed()
                 logging.info("Fan Speed: {}%".format(speed))
-                self.myqtt.publish(final_topic, speed)
-                if self.config.HA_DISCOVERY and not self.first_loop_done:
-                    title = "Argon Fan Speed"
-                    device = self.config.COMPUTER_NAME
-                    for char in (" ", "-"):
-                        device = device.replace(char, "_")
-                    ha_object_id = "s2m_" + device + "_{}".format("fan_speed")
-                    ha_name = "{}".format(title).title()
-                    dtt = self.ha_discovery_template.format(ha_type, ha_object_id)
-                    haconfig = ha_config(discovery_topic=dtt, name=ha_name, object_id=ha_object_id,
-                                         state_topic=final_topic, device=device, icon=ha_icon,
-                                         entity_type=ha_type, unit=ha_unit, 
-                                         availability_topic=self.availability_topic, 
-                                         payload_available="online",
-                                         payload_not_available="offline")
-                    self.myqtt.publish(haconfig[0], haconfig[1], retain=True)
+                self.publish_metric(final_topic, speed)
+                self.discover(ha_type, "fan_speed", "Argon Fan Speed", final_topic, icon=ha_icon, unit=ha_unit)
             except Exception as e:
                 logging.error(e, exc_info=True)
+
+    @collector("hdd_temp", period_key="HDD_TEMP_PERIOD", enabled=lambda config: config.ARGON,
+               backends=("libs.smart",))
+    def publish_hdd_temp(self, snapshot):
+        if self.config.ARGON:
             logging.debug("Getting hdd temperatures")
             slug = "/disks/temperature"
             ha_type = "sensor"
@@ -513,66 +467,318 @@ class System2Mqtt(object):
             # ha_icon = "mdi:thermometer"
             ha_unit = "°C"
             try:
-                temps = gethddtemp()
-                for disk, temp in temps.items():
+                smart = load_backend("libs.smart").get_smart(concurrency=self.config.SMART_CONCURRENCY)
+                if not smart.available():
+                    logging.warning("smartctl not found, no hdd temperatures")
+                    return
+                for disk, reading in smart.read().items():
                     final_topic = self.config.MQTT_BASE_TOPIC + slug + "/" +disk
-                    logging.info("{}: {}°C".format(disk, temp))
-                    self.myqtt.publish(final_topic, temp)
-                    if self.config.HA_DISCOVERY and not self.first_loop_done:
-                        title = disk
-                        for char in (" ", "-"):
-                            disk = disk.lower().replace(char, "_")
-                        device = self.config.COMPUTER_NAME
-                        for char in (" ", "-"):
-                            device = device.replace(char, "_")
-                        ha_object_id = "s2m_"+device+"_{}_{}".format(disk, "temperature")
-                        ha_name = "{} Temperature".format(title).title()
-                        dtt = self.ha_discovery_template.format(ha_type, ha_object_id)
-                        haconfig = ha_config(discovery_topic=dtt, name=ha_name, object_id=ha_object_id,
-                                             state_topic=final_topic, device=device, entity_type=ha_type,
-                                             unit=ha_unit, device_class=ha_class, 
-                                             availability_topic=self.availability_topic, 
-                                             payload_available="online",
-                                             payload_not_available="offline")
-                        self.myqtt.publish(haconfig[0], haconfig[1], retain=True)
+                    logging.info("{}: {}°C{}".format(disk, reading.temperature, " (standby)" if reading.stale else ""))
+                    self.publish_metric(final_topic, reading.temperature)
+                    self.publish_metric(final_topic + "/stale", reading.stale)
+                    self.discover(ha_type, "{}_temperature".format(disk.lower().replace(" ", "_").replace("-", "_")),
+                                  "{} Temperature".format(disk).title(), final_topic, unit=ha_unit, device_class=ha_class)
             except Exception as e:
                 logging.error(e, exc_info=True)
 
-    def publish_lwt_binary_sensor(self):
+    @collector("lwt_binary_sensor", per_node=True)
+    def publish_lwt_binary_sensor(self, snapshot):
+        self.discover("binary_sensor", "lwt", "{} LWT".format(self.config.COMPUTER_NAME), self.lwt_topic, metric=False,
+                      availability_topic=None, device_class="connectivity", payload_on="online", payload_off="offline")
+
+
+################################################################################################
+
+class System2Mqtt(Publisher):
+
+    def __init__(self, conf):
+
+        print("Getting config from:\n", conf)
+
+        self.config = Parser(conf)
+        setupLogging(self.config.DEBUG_LOG, self.config)
+        logging.debug("logging has been set up")
+        lwt_topic = self.config.MQTT_BASE_TOPIC + "/LWT"
+
+        myqtt = Myqtt(host=self.config.MQTT_HOST,
+                      port=self.config.MQTT_PORT,
+                      username=self.config.MQTT_USER,
+                      password=self.config.MQTT_PASSWORD,
+                      protocol_v5=self.config.MQTT_V5,
+                      client_id="s2m_" + self.config.COMPUTER_NAME.replace(" ", "_"),
+                      session_expiry=self.config.MQTT_SESSION_EXPIRY)
+
+        self.availability = Availability(myqtt, lwt_topic)
+        myqtt.availability = self.availability
+        if self.config.PUBLISH_POLICIES:
+            myqtt.policies = PolicyTable(self.config.MQTT_BASE_TOPIC, self.config.PUBLISH_POLICIES)
+
+        pve = None
+        if self.config.PVE_SYSTEM:
+            optimox = load_backend("libs.optimox")
+            pve = optimox.OptiMOX(optimox.prox_auth(self.config.PVE_HOST,
+                                                    self.config.PVE_USER,
+                                                    self.config.PVE_PASSWORD))
+
+        # HA_DISCOVERY_RATE is for the connection, shared by the PVE_NODES targets
+        super().__init__(self.config, myqtt,
+                         Codec(self.config.PAYLOAD_CODEC, compress_min=self.config.PAYLOAD_COMPRESS_MIN),
+                         lwt_topic, RateLimiter(self.config.HA_DISCOVERY_RATE), pve)
+        self.myqtt.topic_callbacks = self.__get_subscription_calbacks()
+
+        if not self.config.PVE_SYSTEM:
+            # prime the cpu counters so the first reading covers a real interval
+            get_cpu_sampler(procpath=self.config.PROCPATH)
+            get_zfs(ttl=self.config.ZFS_CACHE_TTL)
+
+        self.auto_reconnect = True
+
+        self.mounted_disks = []
+        self.mount_watcher = None
+
+        self.publish_period = self.config.PUBLISH_PERIOD
+
+        # scheduler jobs run on behalf of a PVE_NODES target: job name -> (target, collector name)
+        self.job_owners = {}
+        self.scheduler = self.__get_scheduler()
+        self.targets = []
+        if self.config.PVE_SYSTEM:
+            self.targets = [PveTarget(self, node) for node in self.config.PVE_NODES]
+
+        self.first_loop_done = False
+
+    def __get_subscription_calbacks(self):
+        logging.debug("")
+        sub_dict = {self.config.MQTT_BASE_TOPIC + "/tele/PUBLISH_PERIOD": self.s2m_set_publish_period,
+                    self.config.MQTT_BASE_TOPIC + "/callbacks/s2m_quit": self.quit_s2m,
+                    self.config.MQTT_BASE_TOPIC + "/callbacks/shutdown": self.cb_shutdown,
+                    self.config.MQTT_BASE_TOPIC + "/callbacks/reboot": self.cb_reboot}
+        if not self.config.PVE_SYSTEM and mountinfo_available(self.config.PROCPATH):
+            # retained states from before this run, to catch mounts that went away meanwhile
+            sub_dict[self.config.MQTT_BASE_TOPIC + "/disks/mount/+"] = self.on_retained_mount_state
         if self.config.HA_DISCOVERY:
-            ha_type = "binary_sensor"
-            ha_class = "connectivity"
-            device = self.config.COMPUTER_NAME.replace(" ", "_").replace("-", "_")
-            ha_object_id = f"s2m_{device}_lwt"
-            ha_name = f"{self.config.COMPUTER_NAME} LWT"
-            discovery_topic = self.ha_discovery_template.format(ha_type, ha_object_id)
-            haconfig = ha_config(
-                discovery_topic=discovery_topic,
-                name=ha_name,
-                object_id=ha_object_id,
-                state_topic=self.lwt_topic,
-                device=device,
-                entity_type=ha_type,
-                device_class=ha_class,
-                payload_on="online",
-                payload_off="offline"
-            )
-            self.myqtt.publish(haconfig[0], haconfig[1], retain=True)
+            # Home Assistant publishes "online" here when it (re)starts
+            sub_dict[self.config.HA_DISCOVERY_BASE + "/status"] = self.on_ha_status
+        return sub_dict
+
+    def __get_scheduler(self):
+        logging.debug("")
+        scheduler = Scheduler(default_interval=self.publish_period,
+                              workers=self.config.COLLECTOR_WORKERS,
+                              timeout=self.config.COLLECTOR_TIMEOUT)
+        scheduler.status_callback = self.publish_collector_status
+        scheduler.idle_callback = self.collectors_done
+        for spec in enabled_collectors(self.config):
+            if spec.per_node and self.config.PVE_SYSTEM and self.config.PVE_NODES:
+                # every PveTarget schedules its own
+                continue
+            self.schedule(scheduler, spec)
+        return scheduler
+
+    def run(self):
+        self.config.print_config()
+        try:
+            self.process_user_callbacks()
+        except Exception as e:
+            logging.error(e, exc_info=True)
+        if not self.config.PVE_SYSTEM and mountinfo_available(self.config.PROCPATH):
+            self.mount_watcher = MountWatcher(self.publish_mount_changes, procpath=self.config.PROCPATH)
+            self.mount_watcher.start()
+        if self.config.ASYNC_MODE:
+            asyncio.run(self.async_wait())
+        else:
+            self.myqtt.run()
+            self.wait()
+
+    def wait(self):
+        logging.debug("...")
+        while True:
+            while not self.myqtt.client.is_connected():
+                logging.debug("Trying to connect...")
+                if self.spool:
+                    # keep sampling into the spool while the broker is away
+                    self.publish_all()
+                    time.sleep(min(self.scheduler.seconds_until_next(), 1))
+                else:
+                    time.sleep(2)
+            self.start_publish_loop()
+            if not self.auto_reconnect:
+                break
+            logging.info("Reconnecting...")
+        self.scheduler.shutdown()
+        logging.warning("Main Loop Ended!")
+
+    async def async_wait(self):
+        logging.debug("...")
+        loop = asyncio.get_running_loop()
+        state_changed = asyncio.Event()
+        notify = lambda: loop.call_soon_threadsafe(state_changed.set)
+        delay = 1
+
+        def accepted():
+            # only called once the broker accepted the connection (rc == 0)
+            nonlocal delay
+            delay = 1
+            notify()
+        self.myqtt.connected_callback = accepted
+        self.myqtt.disconnected_callback = notify
+        self.scheduler.bind_loop(loop)
+        self.myqtt.run_async(loop)
+        publish_task = None
+        if self.spool:
+            # keep sampling into the spool while the broker is away
+            publish_task = asyncio.create_task(self.async_publish_loop())
+        online = False
+        attempted = False
+        while True:
+            state_changed.clear()
+            if not self.myqtt.client.is_connected():
+                online = False
+                if publish_task and (not self.spool or not self.auto_reconnect):
+                    publish_task.cancel()
+                    publish_task = None
+                if not self.auto_reconnect:
+                    break
+                if attempted:
+                    # refused or dropped connections back off as well
+                    logging.info("Reconnecting in {} seconds".format(delay))
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, 120)
+                attempted = True
+                logging.info("Trying to connect...")
+                try:
+                    await asyncio.to_thread(self.myqtt.connect)
+                except Exception as e:
+                    logging.warning("Connection failed ({})".format(e))
+                    continue
+            elif not online:
+                online = True
+                # the time spent offline is neither lag nor overruns
+                self.scheduler.resync()
+                self.reconnected()
+                if publish_task is None:
+                    publish_task = asyncio.create_task(self.async_publish_loop())
+            await state_changed.wait()
+        self.scheduler.shutdown()
+        logging.warning("Main Loop Ended!")
+
+    async def async_publish_loop(self):
+        logging.info("Publish period is set to {} seconds.".format(self.publish_period))
+        while True:
+            due = self.scheduler.due()
+            if due:
+                logging.debug("...publishing {}".format([job.name for job in due]))
+                self.start_jobs(due, self.scheduler.run_job_async)
+            if not self.first_loop_done and self.scheduler.first_pass_done() and self.myqtt.client.is_connected():
+                logging.info("first publish complete!")
+                self.first_loop_done = True
+            await self.scheduler.sleep_async()
+
+    def reconnected(self):
+        super().reconnected()
+        if self.mount_watcher:
+            self.mount_watcher.refresh()
+        for target in self.targets:
+            target.reconnected()
+
+    def start_publish_loop(self):
+        logging.info("Publish period is set to {} seconds.".format(self.publish_period))
+        # the time spent offline is neither lag nor overruns
+        self.scheduler.resync()
+        self.reconnected()
+        while self.myqtt.client.is_connected():
+            self.publish_all()
+            # wake at least once a second so disconnects and period changes are noticed
+            time.sleep(min(self.scheduler.seconds_until_next(), 1))
+
+    def collectors_done(self):
+        super().collectors_done()
+        for target in self.targets:
+            target.collectors_done()
+
+    def on_retained_mount_state(self, client, userdata, message):
+        """A mount retained as mounted by an earlier run: publish "unmounted" if it is gone."""
+        if not message.retain or self.mount_watcher is None:
+            return
+        if message.payload.decode("utf-8") != "mounted":
+            return
+        label = message.topic.rsplit("/", 1)[-1]
+        if label in {self.mount_label(d) for d in self.mount_watcher.mounts}:
+            return
+        logging.info("{} is no longer mounted - publishing to '{}'".format(label, message.topic))
+        self.myqtt.publish(message.topic, "unmounted", qos=1, retain=True)
+
+    def publish_mount_changes(self, mounted, unmounted):
+        logging.debug("")
+        base = self.config.MQTT_BASE_TOPIC + "/disks/mount/"
+        changes = [(d, "mounted") for d in sorted(mounted)] + [(d, "unmounted") for d in sorted(unmounted)]
+        for d, state in changes:
+            label = self.mount_label(d)
+            if not self.storage_allowed(label, d):
+                continue
+            final_topic = base + label
+            logging.info("{} is {} - publishing to '{}'".format(label, state, final_topic))
+            # QoS 1 so paho queues state changes made while the broker is unreachable
+            self.myqtt.publish(final_topic, state, qos=1, retain=True)
+            self.discover("binary_sensor", "{}_mounted".format(label.lower().replace(" ", "_").replace("-", "_")),
+                          "{} Mount State".format(label).title(), final_topic, metric=False,
+                          payload_on="mounted", payload_off="unmounted", device_class="connectivity")
+        if self.discovery:
+            self.discovery.flush()
+
+    @collector("scheduler_stats")
+    def publish_scheduler_stats(self, snapshot):
+        logging.debug("")
+        base = self.config.MQTT_BASE_TOPIC + "/s2m"
+        try:
+            lag = round(self.scheduler.reset_max_lag(), 3)
+            logging.info("Loop lag: {}s, overruns: {}".format(lag, self.scheduler.overruns))
+            self.publish_metric(base + "/loop_lag", lag)
+            self.publish_metric(base + "/overruns", self.scheduler.overruns)
+        except Exception as e:
+            logging.error(e, exc_info=True)
+
+    @collector("availability_heartbeat", period_key="AVAILABILITY_HEARTBEAT",
+               enabled=lambda config: config.AVAILABILITY_HEARTBEAT > 0)
+    def publish_availability_heartbeat(self, snapshot):
+        self.availability.heartbeat()
+
+    def on_ha_status(self, client, userdata, message):
+        """Home Assistant (re)started: announce availability and send discovery again."""
+        self.availability.on_ha_status(client, userdata, message)
+        if message.payload.decode("utf-8") == "online":
+            for owner in [self] + self.targets:
+                owner.discovery.republish()
+
+    def publish_collector_status(self, job):
+        owner, name = self.job_owners.get(job.name, (self, job.name))
+        final_topic = owner.config.MQTT_BASE_TOPIC + "/collectors/" + name
+        if job.status == "ok":
+            logging.debug("Collector '{}' is ok".format(job.name))
+        else:
+            logging.warning("Collector '{}' is {}, marking it unavailable".format(job.name, job.status))
+        self.myqtt.publish(final_topic, job.status, retain=True)
+
+    def start_jobs(self, due, run_job):
+        """Start the due jobs, each with the snapshot of the system (or PVE node) it collects for."""
+        snapshots = {}
+        self.scheduler.hold()
+        for job in due:
+            owner = self.job_owners.get(job.name, (self, None))[0]
+            if owner not in snapshots:
+                snapshots[owner] = owner.new_snapshot()
+            run_job(job, snapshots[owner])
+        self.scheduler.release()
 
     def publish_all(self):
-        logging.debug("...publishing")
-        self.myqtt.publish(self.lwt_topic, 'online')
-        funcs = [self.publish_lwt_binary_sensor,
-                 self.publish_mount_state,
-                 self.publish_disk_space,
-                 self.publish_cpu_temp,
-                 self.publish_cpu_usage,
-                 self.publish_ram,
-                 self.publish_argon]
-        for f in funcs:
-            f()
-        logging.info("publish complete!")
-        self.first_loop_done = True
+        self.scheduler.reap()
+        due = self.scheduler.due()
+        if due:
+            logging.debug("...publishing {}".format([job.name for job in due]))
+            self.start_jobs(due, self.scheduler.run_job)
+        if not self.first_loop_done and self.scheduler.first_pass_done() and self.myqtt.client.is_connected():
+            logging.info("first publish complete!")
+            self.first_loop_done = True
 
 
 ################################################################################################
@@ -601,10 +807,13 @@ class System2Mqtt(object):
             new_publish_period = int(message.payload.decode("utf-8"))
             if new_publish_period != self.publish_period:
                 self.publish_period = new_publish_period
+                self.scheduler.default_interval = new_publish_period
+                self.scheduler.wake()
                 logging.info("Publish period has been set to {} seconds.".format(self.publish_period))
         except Exception as e:
             logging.error(e, exc_info=True)
             self.publish_period = self.config.PUBLISH_PERIOD
+            self.scheduler.default_interval = self.publish_period
 
     def quit_s2m(self, client, userdata, message):
         logging.debug("")
@@ -612,7 +821,7 @@ class System2Mqtt(object):
             self.auto_reconnect =False
             logging.info("Quit called....")
             self.myqtt.publish(self.config.MQTT_BASE_TOPIC + "/callbacks/s2m_quit", "")
-            self.myqtt.publish(self.lwt_topic, "offline", retain=True)
+            self.availability.goodbye()
             client.loop_stop()
             client.disconnect()
     
@@ -646,6 +855,32 @@ class System2Mqtt(object):
 
 
 
+class PveTarget(Publisher):
+    """One of PVE_NODES, published under its own base topic and Home Assistant device.
+
+    Targets share the agent's MQTT connection, Proxmox API session, codec,
+    scheduler and discovery rate limit, and keep their own publish filter,
+    state document, spool and discovery registry. A connection has only one
+    will, so their entities use the agent's LWT for availability.
+    """
+
+    def __init__(self, agent, node):
+        super().__init__(agent.config.for_node(node), agent.myqtt, agent.codec, agent.lwt_topic,
+                         agent.discovery_limiter, agent.pve)
+        self.agent = agent
+        if self.myqtt.policies:
+            self.myqtt.policies.add_base_topic(self.config.MQTT_BASE_TOPIC)
+        for spec in enabled_collectors(self.config):
+            if spec.per_node:
+                name = "{}/{}".format(node, spec.name)
+                self.schedule(agent.scheduler, spec, name)
+                agent.job_owners[name] = (self, spec.name)
+        logging.info("Monitoring PVE node '{}' on '{}'".format(node, self.config.MQTT_BASE_TOPIC))
+
+    @property
+    def publish_period(self):
+        return self.agent.publish_period
+
 
 if __name__ == '__main__':
     try: